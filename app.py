@@ -1,5 +1,5 @@
 import os
-from flask import Flask, jsonify, request, render_template, redirect, url_for, session
+from flask import Flask, jsonify, request, render_template, redirect, url_for, session, make_response, g
 from flask_login import LoginManager, login_required, current_user, UserMixin
 from flask_sqlalchemy import SQLAlchemy
 from dotenv import load_dotenv
@@ -8,7 +8,22 @@ import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 from sqlalchemy.orm import joinedload # لاستخدام joinedload لجلب البيانات المرتبطة
 from sqlalchemy import func # هذا هو السطر المفقود
-from datetime import datetime
+from sqlalchemy import text, insert, update, select, literal, union
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.schema import CreateColumn, CreateIndex
+from collections import OrderedDict, namedtuple
+import threading
+import csv
+import io
+import json
+import click
+import hashlib
+from functools import wraps
+import heapq
+import base64
+import numpy as np
+import forecasting
+from datetime import datetime, timedelta, timezone
 from flask import jsonify, request, Flask # 👈 يجب استيراد Flask
 from flask_sqlalchemy import SQLAlchemy # 👈 يجب استيراد SQLAlchemy
 from sqlalchemy.orm import joinedload # 👈 قد تحتاجها
@@ -106,6 +121,13 @@ class Product(db.Model):
     retail_price = db.Column(db.Numeric(10, 2))
     supplier = db.Column(db.String(255))
 
+    # فهرس مركّب لعمليات البحث بالباركود داخل نطاق المستخدم (نقاط البيع)
+    __table_args__ = (
+        db.Index('ix_products_user_barcode', 'user_id', 'barcode'),
+        # فهرس للترقيم بالمؤشر (keyset) على id داخل نطاق المستخدم
+        db.Index('ix_products_user_id_id', 'user_id', 'id'),
+    )
+
     def to_dict(self):
         profit_loss = None
         if self.retail_price is not None and self.cost_price is not None:
@@ -145,21 +167,36 @@ class Transaction(db.Model):
 class Sale(db.Model):
     __tablename__ = 'sales'
     sale_id = db.Column(db.Integer, primary_key=True)
-    sale_date = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
+    sale_date = db.Column(db.DateTime(timezone=True), server_default=db.func.now(), index=True)
     total_amount = db.Column(db.Numeric(10, 2), nullable=False)
     payment_method = db.Column(db.String(50))
     amount_paid = db.Column(db.Numeric(10, 2))
     change_amount = db.Column(db.Numeric(10, 2))
     employee_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='SET NULL'))
 
+    # سجل المعاملات يقرأ مبيعات المستخدم مرتبة بالتاريخ (keyset)
+    __table_args__ = (
+        db.Index('ix_sales_employee_date', 'employee_id', 'sale_date', 'sale_id'),
+    )
+
 class SaleItem(db.Model):
     __tablename__ = 'sale_items'
     item_id = db.Column(db.Integer, primary_key=True)
-    sale_id = db.Column(db.Integer, db.ForeignKey('sales.sale_id', ondelete='CASCADE'), nullable=False)
-    product_id = db.Column(db.Integer, db.ForeignKey('products.id', ondelete='CASCADE'), nullable=False)
+    sale_id = db.Column(db.Integer, db.ForeignKey('sales.sale_id', ondelete='CASCADE'), nullable=False, index=True)
+    # حذف المنتج لا يحذف سجل البيع التاريخي
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id', ondelete='SET NULL'), index=True)
     quantity = db.Column(db.Integer, nullable=False)
     price_per_unit = db.Column(db.Numeric(10, 2), nullable=False)
     total_item_price = db.Column(db.Numeric(10, 2), nullable=False)
+
+    # لقطة وقت البيع: المستخدم وسعر التكلفة وتاريخ البيع، حتى لا تحتاج التقارير إلى جدول المنتجات
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'))
+    unit_cost = db.Column(db.Numeric(10, 2))
+    sold_at = db.Column(db.DateTime(timezone=True))
+
+    __table_args__ = (
+        db.Index('ix_sale_items_user_sold_at', 'user_id', 'sold_at'),
+    )
     
 class Return(db.Model):
     __tablename__ = 'returns'
@@ -180,6 +217,10 @@ class Return(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
     user = db.relationship('User', backref=db.backref('returns', lazy=True))
 
+    __table_args__ = (
+        db.Index('ix_returns_user_date', 'user_id', 'return_date', 'return_id'),
+    )
+
     def to_dict(self):
         return {
             "id": self.return_id,
@@ -198,9 +239,13 @@ class Expense(db.Model):
     __tablename__ = 'expenses'
     expense_id = db.Column(db.Integer, primary_key=True)
     description = db.Column(db.Text, nullable=False)
-    amount = db.Column(db.Numeric(10, 2), nullable=False)
-    expense_date = db.Column(db.Date, nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=True) 
+    # active_history: القيمة القديمة تُحمّل عند التعديل حتى لو انتهت صلاحية الكائن بعد commit،
+    # فمستمع after_update يعكسها من الملخص اليومي
+    amount = db.column_property(db.Column(db.Numeric(10, 2), nullable=False), active_history=True)
+    expense_date = db.column_property(db.Column(db.Date, nullable=False), active_history=True)
+    user_id = db.column_property(
+        db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=True), active_history=True
+    )
     user = db.relationship('User', backref=db.backref('expenses', lazy=True))
 
 class ProfitLossReport(db.Model):
@@ -228,6 +273,29 @@ class LowStockAlert(db.Model):
     alert_date = db.Column(db.Date, nullable=False)
     current_quantity = db.Column(db.Integer, nullable=False)
 
+    # يكتبها أمر compute_reorder_points
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), index=True)
+    daily_velocity = db.Column(db.Numeric(12, 4))  # متوسط الكمية المباعة يومياً
+    days_of_cover = db.Column(db.Numeric(10, 2))   # فارغ إذا لم يُبع المنتج في الفترة
+    reorder_point = db.Column(db.Integer)
+    suggested_order_quantity = db.Column(db.Integer)
+
+    # تنبيه واحد لكل منتج (فهرس مسمى حتى تنشئه الترقية على الجداول القائمة)
+    __table_args__ = (
+        db.Index('uq_low_stock_alerts_product_id', 'product_id', unique=True),
+    )
+
+    def to_dict(self):
+        return {
+            "product_id": self.product_id,
+            "alert_date": self.alert_date.isoformat(),
+            "current_quantity": self.current_quantity,
+            "daily_velocity": float(self.daily_velocity) if self.daily_velocity is not None else None,
+            "days_of_cover": float(self.days_of_cover) if self.days_of_cover is not None else None,
+            "reorder_point": self.reorder_point,
+            "suggested_order_quantity": self.suggested_order_quantity
+        }
+
 class TrialBalanceAccount(db.Model):
     __tablename__ = 'trial_balance_accounts'
     account_id = db.Column(db.Integer, primary_key=True)
@@ -260,6 +328,14 @@ class Customer(db.Model):
     total_debt = db.Column(db.Numeric(10, 2), default=0.00) 
     total_paid = db.Column(db.Numeric(10, 2), default=0.00) 
     products_sold_summary = db.Column(db.Text) 
+    # عدد قيود الدفتر منذ آخر لقطة رصيد (يُحدَّث ذرياً مع الأرصدة)
+    ledger_entries_since_snapshot = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (
+        # دليل العملاء: ترتيب بالاسم والبحث بالبادئة في الهاتف (الاسم والبريد بعد تعريف الجدول)
+        db.Index('ix_customers_user_name', 'user_id', 'name', 'customer_id'),
+        db.Index('ix_customers_user_phone', 'user_id', 'phone'),
+    )
 
     # 4. التجسيد كقاموس (يجب تحديثها لتعكس الأعمدة الجديدة)
     def to_dict(self):
@@ -278,21 +354,533 @@ class Customer(db.Model):
             'remaining_debt': float(self.total_debt - self.total_paid)
         }
     
+# الرصيد المتبقي كتعبير مفهرس: أكبر المدينين وتقرير الأعمار يقرآن النطاق (user_id, المتبقي) مباشرة
+CUSTOMER_REMAINING_DEBT = Customer.total_debt - Customer.total_paid
+db.Index('ix_customers_user_remaining', Customer.user_id, CUSTOMER_REMAINING_DEBT, Customer.customer_id)
+
+# البحث في الاسم والبريد لا يتأثر بحالة الأحرف: الفهرس على lower() والبادئة تُحوَّل لأحرف صغيرة
+CUSTOMER_NAME_LOWER = func.lower(Customer.name)
+CUSTOMER_EMAIL_LOWER = func.lower(Customer.email)
+db.Index('ix_customers_user_name_lower', Customer.user_id, CUSTOMER_NAME_LOWER)
+db.Index('ix_customers_user_email_lower', Customer.user_id, CUSTOMER_EMAIL_LOWER)
+
+
+class CustomerLedgerEntry(db.Model):
+    """قيد في دفتر ديون العميل (إلحاق فقط): دين جديد أو تسديد، ولا يُعدل بعد كتابته."""
+    __tablename__ = 'customer_ledger_entries'
+    entry_id = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customers.customer_id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    entry_type = db.Column(db.String(20), nullable=False)  # 'debt' أو 'payment'
+    amount = db.Column(db.Numeric(12, 2), nullable=False)
+    note = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        # كشف الحساب والأرصدة في لحظة معينة تقرأ مدى زمنياً لعميل واحد
+        db.Index('ix_customer_ledger_customer_created', 'customer_id', 'created_at'),
+    )
+
+    def to_dict(self):
+        return {
+            'entry_id': self.entry_id,
+            'customer_id': self.customer_id,
+            'entry_type': self.entry_type,
+            'amount': float(self.amount),
+            'note': self.note,
+            'created_at': self.created_at.isoformat()
+        }
+
+
+class CustomerBalanceSnapshot(db.Model):
+    """رصيد العميل بعد قيد معين، يُكتب كل LEDGER_SNAPSHOT_INTERVAL قيداً حتى لا نعيد مسح الدفتر كاملاً."""
+    __tablename__ = 'customer_balance_snapshots'
+    snapshot_id = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customers.customer_id', ondelete='CASCADE'), nullable=False)
+    # آخر قيد مشمول في اللقطة ووقته
+    entry_id = db.Column(db.Integer, nullable=False)
+    taken_at = db.Column(db.DateTime, nullable=False)
+    total_debt = db.Column(db.Numeric(12, 2), nullable=False)
+    total_paid = db.Column(db.Numeric(12, 2), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_customer_snapshots_customer_taken', 'customer_id', 'taken_at'),
+    )
+
+
+class ResourceVersion(db.Model):
+    """عداد إصدار لكل (نطاق، مورد) يزداد مع كل كتابة ويُستخدم كـ ETag لقوائم الـ API."""
+    __tablename__ = 'resource_versions'
+    # النطاق هو user_id للمنتجات/العملاء/المرتجعات و company_id للموظفين
+    scope_id = db.Column(db.Integer, primary_key=True)
+    resource = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+class ProductChange(db.Model):
+    """سجل تغييرات المنتجات (إضافة/تعديل/حذف) لمزامنة نقاط البيع تزايدياً."""
+    __tablename__ = 'product_changes'
+    change_id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    # بدون مفتاح خارجي: سجل الحذف (tombstone) يبقى بعد حذف المنتج
+    product_id = db.Column(db.Integer, nullable=False)
+    deleted = db.Column(db.Boolean, nullable=False, default=False)
+    changed_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
+
+    __table_args__ = (
+        db.Index('ix_product_changes_user_change', 'user_id', 'change_id'),
+    )
+
+class IdempotencyKey(db.Model):
+    """الاستجابة المحفوظة لطلب كتابة يحمل ترويسة Idempotency-Key (لإعادة المحاولة الآمنة)."""
+    __tablename__ = 'idempotency_keys'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    key = db.Column(db.String(255), nullable=False)
+    endpoint = db.Column(db.String(100), nullable=False)
+    # فارغة طالما الطلب الأصلي قيد التنفيذ
+    status_code = db.Column(db.Integer)
+    response_body = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'key', name='uq_idempotency_user_key'),
+    )
+
+class DailyRollup(db.Model):
+    """ملخص يومي لكل مستخدم (إيرادات، تكلفة، كميات، مرتجعات، مصروفات) تقرأ منه التقارير."""
+    __tablename__ = 'daily_rollups'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    revenue = db.Column(db.Numeric(14, 2), nullable=False, default=0)
+    cogs = db.Column(db.Numeric(14, 2), nullable=False, default=0)
+    items_sold = db.Column(db.Integer, nullable=False, default=0)
+    sales_count = db.Column(db.Integer, nullable=False, default=0)
+    returned_items = db.Column(db.Integer, nullable=False, default=0)
+    returns_amount = db.Column(db.Numeric(14, 2), nullable=False, default=0)
+    expenses = db.Column(db.Numeric(14, 2), nullable=False, default=0)
+
+ROLLUP_METRICS = ('revenue', 'cogs', 'items_sold', 'sales_count', 'returned_items', 'returns_amount', 'expenses')
+
+
+class SalesForecast(db.Model):
+    """آخر توقع محسوب لكل مستخدم (يكتبه أمر compute_forecasts ويقرأه /api/forecasts مباشرة)."""
+    __tablename__ = 'sales_forecasts'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    computed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # النموذج المختار ومعاملاته لكل سلسلة (revenue/profit) بصيغة JSON
+    params = db.Column(db.Text, nullable=False)
+    # التوقع الشهري واليومي مع حدود الثقة بصيغة JSON جاهزة للإرسال
+    payload = db.Column(db.Text, nullable=False)
+
+# =========================================================================
+# دوال مساعدة: عدادات الإصدار و ETag للطلبات الشرطية
+# =========================================================================
+
+def bump_resource_version(resource, scope_id, executor=None):
+    """يزيد عداد إصدار المورد داخل المعاملة الحالية (يجب استدعاؤها قبل commit)."""
+    if scope_id is None:
+        return
+    executor = executor if executor is not None else db.session
+    bump = (
+        update(ResourceVersion)
+        .where(ResourceVersion.scope_id == scope_id, ResourceVersion.resource == resource)
+        .values(version=ResourceVersion.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    if executor.execute(bump).rowcount:
+        return
+    try:
+        with executor.begin_nested():
+            executor.execute(insert(ResourceVersion).values(scope_id=scope_id, resource=resource, version=1))
+    except IntegrityError:
+        # أنشأه طلب متزامن في نفس اللحظة
+        executor.execute(bump)
+
+
+def record_product_changes(user_id, product_ids, deleted=False):
+    """يسجل تغيير المنتجات في سجل المزامنة ويزيد إصدار قائمة المنتجات (قبل commit)."""
+    product_ids = {pid for pid in product_ids if pid is not None}
+    if user_id is None or not product_ids:
+        return
+    db.session.execute(insert(ProductChange), [
+        {"user_id": user_id, "product_id": pid, "deleted": deleted} for pid in sorted(product_ids)
+    ])
+    bump_resource_version('products', user_id)
+
+
+def add_to_daily_rollup(user_id, day, executor=None, **deltas):
+    """يضيف الفروق إلى ملخص اليوم داخل المعاملة الحالية (UPDATE ذري ثم INSERT عند الغياب)."""
+    deltas = {k: v for k, v in deltas.items() if v}
+    if user_id is None or day is None or not deltas:
+        return
+    executor = executor if executor is not None else db.session
+    # كل تغيير في الملخصات يبطل التقارير المخزنة مؤقتاً لهذا المستخدم
+    bump_resource_version('reports', user_id, executor)
+    bump = (
+        update(DailyRollup)
+        .where(DailyRollup.user_id == user_id, DailyRollup.day == day)
+        .values(**{k: getattr(DailyRollup, k) + v for k, v in deltas.items()})
+        .execution_options(synchronize_session=False)
+    )
+    if executor.execute(bump).rowcount:
+        return
+    row = {k: 0 for k in ROLLUP_METRICS}
+    row.update(deltas, user_id=user_id, day=day)
+    try:
+        with executor.begin_nested():
+            executor.execute(insert(DailyRollup).values(**row))
+    except IntegrityError:
+        executor.execute(bump)
+
+
+@db.event.listens_for(Expense, 'after_insert')
+def _expense_inserted(mapper, connection, target):
+    add_to_daily_rollup(target.user_id, target.expense_date, connection, expenses=Decimal(str(target.amount)))
+
+
+@db.event.listens_for(Expense, 'after_delete')
+def _expense_deleted(mapper, connection, target):
+    add_to_daily_rollup(target.user_id, target.expense_date, connection, expenses=-Decimal(str(target.amount)))
+
+
+@db.event.listens_for(Expense, 'after_update')
+def _expense_updated(mapper, connection, target):
+    # نعكس القيمة القديمة ثم نضيف الجديدة (قد يتغير المبلغ أو التاريخ أو المستخدم)
+    state = db.inspect(target)
+    old = {}
+    for attr in ('user_id', 'expense_date', 'amount'):
+        history = state.attrs[attr].history
+        old[attr] = history.deleted[0] if history.deleted else getattr(target, attr)
+    add_to_daily_rollup(old['user_id'], old['expense_date'], connection, expenses=-Decimal(str(old['amount'])))
+    add_to_daily_rollup(target.user_id, target.expense_date, connection, expenses=Decimal(str(target.amount)))
+
+
+def conditional_list_response(resource, scope_id, build_response):
+    """يرد بـ 304 إذا لم يتغير المورد منذ آخر ETag، وإلا يبني الاستجابة ويرفق ETag."""
+    version = db.session.query(ResourceVersion.version).filter_by(
+        scope_id=scope_id, resource=resource
+    ).scalar() or 0
+    # معاملات الاستعلام (fields/cursor/...) جزء من المفتاح
+    query_digest = hashlib.sha1(request.query_string).hexdigest()[:12]
+    etag = f"{resource}-{scope_id}-{version}-{query_digest}"
+
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+    else:
+        response = make_response(build_response())
+        if response.status_code != 200:
+            return response
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# =========================================================================
+# دوال مساعدة: مفاتيح عدم التكرار (Idempotency-Key) لطلبات الكتابة
+# =========================================================================
+
+IDEMPOTENCY_KEY_TTL = timedelta(hours=24)
+# حجز بدون استجابة أقدم من هذا يُعد متروكاً (عملية انتهت قبل تسجيل النتيجة)
+IDEMPOTENCY_RESERVATION_TIMEOUT = timedelta(minutes=5)
+
+
+def release_idempotency_key(user_id, key):
+    """يحذف حجز المفتاح حتى يتمكن العميل من إعادة المحاولة بالمفتاح نفسه."""
+    IdempotencyKey.query.filter_by(user_id=user_id, key=key).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def idempotent(endpoint_name):
+    """يحفظ أول استجابة ناجحة لكل Idempotency-Key ويعيدها عند تكرار الطلب دون إعادة التنفيذ."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request.headers.get('Idempotency-Key')
+            user_id = session.get('user_id')
+            if not key or user_id is None or 'logged_in' not in session:
+                return view(*args, **kwargs)
+            if len(key) > 255:
+                return jsonify({"error": "قيمة Idempotency-Key طويلة جداً."}), 400
+
+            # بحث واحد عبر الفهرس الفريد (user_id, key)
+            record = IdempotencyKey.query.filter_by(user_id=user_id, key=key).first()
+            now = datetime.utcnow()
+            if record and (
+                record.created_at < now - IDEMPOTENCY_KEY_TTL
+                or (record.status_code is None and record.created_at < now - IDEMPOTENCY_RESERVATION_TIMEOUT)
+            ):
+                db.session.delete(record)
+                db.session.commit()
+                record = None
+
+            if record:
+                if record.endpoint != endpoint_name:
+                    return jsonify({"error": "تم استخدام مفتاح Idempotency-Key مع عملية أخرى."}), 422
+                if record.status_code is None:
+                    return jsonify({"error": "طلب بنفس المفتاح قيد التنفيذ، أعد المحاولة لاحقاً."}), 409
+                response = make_response(record.response_body, record.status_code)
+                response.mimetype = 'application/json'
+                response.headers['Idempotent-Replayed'] = 'true'
+                return response
+
+            # حجز المفتاح قبل التنفيذ حتى لا تُنفذ محاولتان متزامنتان معاً
+            try:
+                db.session.add(IdempotencyKey(user_id=user_id, key=key, endpoint=endpoint_name))
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                return jsonify({"error": "طلب بنفس المفتاح قيد التنفيذ، أعد المحاولة لاحقاً."}), 409
+
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Exception:
+                # استثناء غير معالج: نتراجع عن عمل الطلب ونحرر المفتاح ثم نعيد رفع الخطأ
+                db.session.rollback()
+                release_idempotency_key(user_id, key)
+                raise
+
+            if not 200 <= response.status_code < 300:
+                # فشل الطلب: نحرر المفتاح ليتمكن العميل من إعادة المحاولة
+                db.session.rollback()
+                release_idempotency_key(user_id, key)
+                return response
+
+            record = IdempotencyKey.query.filter_by(user_id=user_id, key=key).first()
+            if record is not None:
+                record.status_code = response.status_code
+                record.response_body = response.get_data(as_text=True)
+                db.session.commit()
+            return response
+        return wrapper
+    return decorator
+
+
+@app.cli.command("sweep_idempotency_keys")
+def sweep_idempotency_keys():
+    """يحذف مفاتيح عدم التكرار المنتهية صلاحيتها."""
+    cutoff = datetime.utcnow() - IDEMPOTENCY_KEY_TTL
+    deleted = IdempotencyKey.query.filter(IdempotencyKey.created_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    print(f"تم حذف {deleted} مفتاح منتهي الصلاحية.")
+
+# =========================================================================
+# سياق المستخدم (tenant) للطلب: المستخدم والدور والشركة مرة واحدة لكل طلب
+# =========================================================================
+
+class LRUTTLCache:
+    """ذاكرة LRU داخل العملية بواجهة cachelib نفسها (get/set/clear) مع انتهاء صلاحية."""
+
+    def __init__(self, max_entries=1024, default_timeout=300):
+        self.max_entries = max_entries
+        self.default_timeout = default_timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < datetime.utcnow():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        timeout = self.default_timeout if timeout is None else timeout
+        with self._lock:
+            self._entries[key] = (datetime.utcnow() + timedelta(seconds=timeout), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        return True
+
+
+TENANT_CONTEXT_TTL = int(os.getenv('TENANT_CONTEXT_TTL', 30))
+
+TenantContext = namedtuple('TenantContext', ['user_id', 'role', 'company_id'])
+
+# ذاكرة مشتركة في العملية؛ المدة القصيرة تحد من تأخر التغييرات القادمة من عمال آخرين
+tenant_context_cache = LRUTTLCache(max_entries=4096, default_timeout=TENANT_CONTEXT_TTL)
+
+
+def get_tenant_context():
+    """يعيد سياق المستخدم المسجل (أو None)، محسوباً مرة واحدة لكل طلب ومخزناً في g."""
+    if 'tenant' in g:
+        return g.tenant
+    tenant = None
+    user_id = session.get('user_id') if session.get('logged_in') else None
+    if user_id is not None:
+        tenant = tenant_context_cache.get(user_id)
+        if tenant is None:
+            row = db.session.query(User.id, User.role, User.company_id).filter(User.id == user_id).first()
+            if row is not None:
+                tenant = TenantContext(*row)
+                tenant_context_cache.set(user_id, tenant)
+    g.tenant = tenant
+    return tenant
+
+
+def tenant_required(view):
+    """يتحقق من تسجيل الدخول ويحمّل سياق المستخدم في g.tenant قبل تنفيذ المسار."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if 'logged_in' not in session or 'user_id' not in session:
+            return jsonify({"error": "غير مصرح لك بالوصول"}), 401
+        if get_tenant_context() is None:
+            return jsonify({"error": "بيانات المستخدم غير موجودة."}), 404
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def company_required(view):
+    """مثل tenant_required ويتطلب أن يكون المستخدم مرتبطاً بشركة."""
+    @wraps(view)
+    @tenant_required
+    def wrapper(*args, **kwargs):
+        if g.tenant.company_id is None:
+            return jsonify({"error": "المستخدم الحالي غير مرتبط بشركة"}), 404
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@db.event.listens_for(User, 'after_update')
+@db.event.listens_for(User, 'after_delete')
+def _user_changed(mapper, connection, target):
+    tenant_context_cache.delete(target.id)
+
+
+@db.event.listens_for(Company, 'after_update')
+@db.event.listens_for(Company, 'after_delete')
+def _company_changed(mapper, connection, target):
+    # نادر الحدوث: نفرغ الذاكرة بدل تتبع مستخدمي الشركة
+    tenant_context_cache.clear()
+
+
 # =========================================================================
 # مسارات التطبيق (Routes)
 # =========================================================================
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return db.session.get(User, int(user_id))
+
+# =========================================================================
+# ترقية قاعدة بيانات قائمة: create_all ينشئ الجداول الجديدة فقط ولا يعدّل الجداول الموجودة
+# =========================================================================
+
+# أعمدة أُضيفت إلى جداول موجودة (تُضاف بـ ALTER TABLE إذا لم تكن موجودة)
+SCHEMA_UPGRADES = {
+    'sale_items': ('user_id', 'unit_cost', 'sold_at'),
+    'customers': ('ledger_entries_since_snapshot',),
+    'low_stock_alerts': ('user_id', 'daily_velocity', 'days_of_cover', 'reorder_point', 'suggested_order_quantity'),
+}
+
+
+def add_missing_columns(connection):
+    inspector = db.inspect(connection)
+    for table_name, column_names in SCHEMA_UPGRADES.items():
+        existing = {column['name'] for column in inspector.get_columns(table_name)}
+        for column in db.metadata.tables[table_name].c:
+            if column.name not in column_names or column.name in existing:
+                continue
+            ddl = str(CreateColumn(column).compile(dialect=connection.dialect))
+            for fk in column.foreign_keys:
+                ddl += f" REFERENCES {fk.column.table.name} ({fk.column.name})"
+                if fk.ondelete:
+                    ddl += f" ON DELETE {fk.ondelete}"
+            connection.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {ddl}"))
+
+
+def upgrade_sale_items_product_fk(connection):
+    """حذف المنتج لم يعد يحذف أسطر البيع: product_id يقبل NULL والمفتاح الأجنبي SET NULL."""
+    if connection.dialect.name != 'postgresql':
+        return  # SQLite لا يدعم ALTER COLUMN ولا يفرض المفاتيح الأجنبية افتراضياً
+    connection.execute(text("ALTER TABLE sale_items ALTER COLUMN product_id DROP NOT NULL"))
+    for fk in db.inspect(connection).get_foreign_keys('sale_items'):
+        if fk['referred_table'] != 'products' or fk['options'].get('ondelete', '').upper() == 'SET NULL':
+            continue
+        connection.execute(text(f'ALTER TABLE sale_items DROP CONSTRAINT "{fk["name"]}"'))
+        connection.execute(text(
+            "ALTER TABLE sale_items ADD CONSTRAINT sale_items_product_id_fkey "
+            "FOREIGN KEY (product_id) REFERENCES products (id) ON DELETE SET NULL"
+        ))
+
+
+def upgrade_low_stock_alerts(connection):
+    """ينسب التنبيهات القديمة لمالك المنتج ويبقي الأحدث لكل منتج قبل إنشاء الفهرس الفريد."""
+    alerts = LowStockAlert.__table__
+    connection.execute(
+        alerts.update().where(alerts.c.user_id.is_(None)).values(
+            user_id=select(Product.user_id).where(Product.id == alerts.c.product_id).scalar_subquery()
+        )
+    )
+    latest = select(func.max(alerts.c.alert_id)).group_by(alerts.c.product_id)
+    connection.execute(alerts.delete().where(alerts.c.alert_id.not_in(latest)))
+
+
+# فهارس استُبدلت بفهارس أخرى
+REPLACED_INDEXES = ('ix_customers_user_email',)
+
+
+def drop_replaced_indexes(connection):
+    for name in REPLACED_INDEXES:
+        connection.execute(text(f"DROP INDEX IF EXISTS {name}"))
+
+
+# خطوات تُنفذ بعد إضافة الأعمدة؛ كل خطوة يجب أن تكون آمنة عند التكرار
+SCHEMA_UPGRADE_STEPS = [
+    upgrade_sale_items_product_fk,
+    upgrade_low_stock_alerts,
+    drop_replaced_indexes,
+]
+
+
+def upgrade_schema():
+    """ينشئ الجداول الجديدة ويضيف الأعمدة والفهارس الناقصة (يمكن استدعاؤها أكثر من مرة)."""
+    db.create_all()
+    with db.engine.begin() as connection:
+        add_missing_columns(connection)
+        for step in SCHEMA_UPGRADE_STEPS:
+            step(connection)
+        # IF NOT EXISTS بدل checkfirst: الانعكاس لا يرى الفهارس المبنية على تعبيرات
+        for table in db.metadata.tables.values():
+            for index in table.indexes:
+                connection.execute(CreateIndex(index, if_not_exists=True))
+
 
 # مسار لإنشاء الجداول في قاعدة البيانات
 @app.cli.command("create_db")
 def create_db():
     """ينشئ جميع الجداول في قاعدة البيانات."""
-    db.create_all()
+    upgrade_schema()
+    setup_product_search_index()
     print("تم إنشاء الجداول بنجاح!")
 
+
+@app.cli.command("upgrade_db")
+def upgrade_db():
+    """يرقّي قاعدة بيانات قائمة إلى المخطط الحالي.
+
+    ترتيب الترقية:
+        flask --app app upgrade_db
+        flask --app app backfill_sale_item_costs
+        flask --app app rebuild_rollups
+    """
+    upgrade_schema()
+    setup_product_search_index()
+    print("تمت ترقية قاعدة البيانات بنجاح!")
+
 # مسار لعرض صفحة المشرف
 @app.route('/admin')
 def admin_panel():
@@ -512,20 +1100,10 @@ from datetime import datetime
 # تأكد من استيراد generate_password_hash إذا كان نموذجك يتطلبه
 
 @app.route('/api/employees', methods=['POST'])
+@company_required
 def add_employee():
-    # التحقق من تسجيل الدخول
-    if 'logged_in' not in session or 'user_id' not in session:
-        return jsonify({"error": "غير مصرح لك بالوصول"}), 401
-    
     data = request.get_json()
-    user_id = session['user_id']
-    company_admin = User.query.get(user_id)
-
-    # ... (كود التحقق من الشركة - صحيح) ...
-    if not company_admin or not company_admin.company:
-        return jsonify({"error": "المستخدم الحالي غير مرتبط بشركة"}), 404
-    
-    company_id = company_admin.company.company_id
+    company_id = g.tenant.company_id
     
     try:
         # التأكد من توفر البيانات الأساسية
@@ -555,6 +1133,7 @@ def add_employee():
             # status='active'
         )
         db.session.add(new_employee)
+        bump_resource_version('employees', company_id)
         db.session.commit()
         
         # ... (بقية كود النجاح - صحيح) ...
@@ -578,32 +1157,34 @@ def add_employee():
 # -------------------------
 
 @app.route('/api/employees', methods=['GET'])
+@tenant_required
 def list_employees():
-    # التحقق من تسجيل الدخول
-    if 'logged_in' not in session or 'user_id' not in session:
-        return jsonify({"error": "غير مصرح لك"}), 401
-
-    user_id = session['user_id']
-    current_user = User.query.get(user_id)
-
     # 1. جلب company_id للمستخدم الحالي
-    if not current_user or not current_user.company:
+    if g.tenant.company_id is None:
         # هذه الحالة قد تحدث إذا كان المستخدم super_admin غير مرتبط بشركة
-        if current_user and current_user.role == 'super_admin':
+        if g.tenant.role == 'super_admin':
             # إذا كان مشرف عام، يمكنك السماح له برؤية كل شيء أو إعطاء قائمة فارغة حسب متطلباتك
             employees = User.query.filter(User.role.in_(['employee', 'company_admin'])).all()
         else:
             return jsonify({"error": "المستخدم غير مرتبط بشركة لعرض موظفيها"}), 404
     else:
-        company_id = current_user.company.company_id
+        company_id = g.tenant.company_id
 
         # 2. الاستعلام الصحيح: جلب كل مستخدمي الشركة الذين هم موظفون أو مدراء
-        employees = User.query.filter(
-            User.company_id == company_id,
-            User.role.in_(['employee', 'company_admin'])
-        ).all()
+        def build():
+            employees = User.query.filter(
+                User.company_id == company_id,
+                User.role.in_(['employee', 'company_admin'])
+            ).all()
+            return serialize_employees(employees)
+
+        return conditional_list_response('employees', company_id, build)
     
     # 3. إعادة البيانات بصيغة JSON
+    return serialize_employees(employees)
+
+
+def serialize_employees(employees):
     return jsonify([{
         "id": emp.id,
         "name": emp.name,
@@ -621,19 +1202,11 @@ from datetime import datetime
 from datetime import datetime # تأكد من استيراد هذه المكتبة
 
 @app.route('/api/employees/<int:employee_id>', methods=['GET', 'PUT', 'DELETE'])
+@company_required
 def manage_employee(employee_id):
-    # 1. التحقق من تسجيل الدخول
-    if 'logged_in' not in session or 'user_id' not in session:
-        return jsonify({"error": "غير مصرح لك بالوصول"}), 401
-
-    user_id = session['user_id']
-    current_user = User.query.get(user_id)
-    
-    # تحديد ID الشركة للمستخدم الحالي
-    if not current_user or not current_user.company:
-        return jsonify({"error": "المستخدم الحالي غير مرتبط بشركة"}), 404
-        
-    company_id = current_user.company.company_id
+    # 1. سياق المستخدم (التحقق من الدخول والشركة في company_required)
+    user_id = g.tenant.user_id
+    company_id = g.tenant.company_id
 
     # 2. جلب الموظف بالاعتماد على ID الموظف و ID الشركة (للصلاحية)
     employee = User.query.filter_by(id=employee_id, company_id=company_id).first()
@@ -681,6 +1254,7 @@ def manage_employee(employee_id):
 
             employee.email = data.get('email', employee.email)
             
+            bump_resource_version('employees', company_id)
             db.session.commit()
             return jsonify({"message": "تم تحديث بيانات الموظف بنجاح"}), 200
 
@@ -698,6 +1272,7 @@ def manage_employee(employee_id):
                  return jsonify({"error": "لا يمكن حذف حساب المدير النشط. قم بتعيين مدير جديد أولاً."}), 403
 
             db.session.delete(employee)
+            bump_resource_version('employees', company_id)
             db.session.commit()
             return jsonify({"message": "تم حذف الموظف بنجاح"}), 200
             
@@ -708,6 +1283,7 @@ def manage_employee(employee_id):
 # =========================================================================
 # API: إضافة عميل جديد
 @app.route('/api/customers', methods=['POST'])
+@idempotent('customers')
 def add_new_customer():
     # ... (التحقق من تسجيل الدخول والـ session) ...
     if 'logged_in' not in session or 'user_id' not in session:
@@ -718,11 +1294,13 @@ def add_new_customer():
         user_id = session['user_id']
         
         # التأكد من تحويل القيم الرقمية، واستخدام 0.00 كقيمة افتراضية إذا كانت مفقودة
-        debt = float(data.get('initial_debt', 0.00)) 
-        paid = float(data.get('initial_paid', 0.00)) 
+        debt = Decimal(str(data.get('initial_debt') or 0)) 
+        paid = Decimal(str(data.get('initial_paid') or 0)) 
 
         if not data.get('name'):
             return jsonify({"error": "اسم العميل إلزامي."}), 400
+        if debt < 0 or paid < 0:
+            return jsonify({"error": "المبالغ الافتتاحية يجب أن تكون موجبة."}), 400
 
         new_customer = Customer(
             user_id=user_id,
@@ -737,14 +1315,20 @@ def add_new_customer():
             contact_info=data.get('contact_info'),
             products_sold_summary=data.get('products_sold_summary'),
             
-            # أعمدة الديون
-            total_debt=debt, 
-            total_paid=paid
+            # أعمدة الديون: تبدأ من الصفر ثم تُسجل الأرصدة الافتتاحية كقيود في الدفتر
+            total_debt=0, 
+            total_paid=0
             
             # ملاحظة: إذا كان لديك عمود 'created_at' في كلاس Customer، لا تحتاج لتمريره هنا لأنه يتم تعيينه تلقائياً.
         )
         
         db.session.add(new_customer)
+        db.session.flush()
+        if debt:
+            post_ledger_entry(new_customer, 'debt', debt, LEDGER_OPENING_NOTE)
+        if paid:
+            post_ledger_entry(new_customer, 'payment', paid, LEDGER_OPENING_NOTE)
+        bump_resource_version('customers', user_id)
         db.session.commit()
         
         return jsonify({"message": "تم إضافة العميل بنجاح.", "customer": new_customer.to_dict()}), 201
@@ -763,10 +1347,134 @@ def get_all_customers():
 
     user_id = session['user_id']
     
-    # جلب جميع العملاء المرتبطين بمعرّف المستخدم الحالي فقط
-    customers = Customer.query.filter_by(user_id=user_id).all()
-    
-    return jsonify([c.to_dict() for c in customers]), 200
+    # جلب عملاء المستخدم الحالي فقط (مع ترقيم بالمؤشر، ترتيب، وبحث بالبادئة)
+    return conditional_list_response('customers', user_id, lambda: build_customers_list(user_id, request.args))
+
+
+CUSTOMER_SORTS = ('name', 'remaining_debt')
+CUSTOMER_STATUSES = ('all', 'unpaid', 'paid')
+CUSTOMERS_DEFAULT_PAGE_SIZE = 50
+CUSTOMERS_MAX_PAGE_SIZE = 200
+# حتى هذا الحد يُعد العملاء بدقة، وبعده نكتفي بتقدير
+CUSTOMERS_EXACT_COUNT_LIMIT = 10000
+# أكبر محرف في Unicode: كل نص يبدأ بالبادئة يقع في [البادئة، البادئة + هذا المحرف)
+PREFIX_UPPER_BOUND = '\U0010ffff'
+
+
+def prefix_match(column, prefix):
+    """بحث بالبادئة كمدى (>= و <) حتى يستخدم فهرس B-tree العادي على كل قواعد البيانات."""
+    return db.and_(column >= prefix, column < prefix + PREFIX_UPPER_BOUND)
+
+
+def encode_customers_cursor(value, customer_id):
+    return base64.urlsafe_b64encode(json.dumps([value, customer_id]).encode()).decode()
+
+
+def decode_customers_cursor(cursor, sort):
+    value, customer_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if sort == 'remaining_debt' and value is not None:
+        value = Decimal(value)
+    return value, int(customer_id)
+
+
+def estimate_customers_count(query):
+    """عدد العملاء المطابقين: عدّ محدود بـ CUSTOMERS_EXACT_COUNT_LIMIT صفاً، وبعده تقدير.
+
+    على Postgres التقدير من خطة الاستعلام (EXPLAIN) بدل COUNT(*) على كل الصفوف،
+    وعلى غيره نعيد الحد نفسه مع علامة التقدير. يعيد (العدد، هل هو تقدير).
+    """
+    capped = db.session.execute(
+        select(func.count()).select_from(
+            query.with_entities(Customer.customer_id).order_by(None).limit(CUSTOMERS_EXACT_COUNT_LIMIT + 1).subquery()
+        )
+    ).scalar()
+    if capped <= CUSTOMERS_EXACT_COUNT_LIMIT:
+        return capped, False
+
+    if db.engine.dialect.name == 'postgresql':
+        compiled = query.with_entities(Customer.customer_id).order_by(None).statement.compile(dialect=db.engine.dialect)
+        plan = db.session.connection().exec_driver_sql('EXPLAIN (FORMAT JSON) ' + str(compiled), compiled.params).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return max(int(plan[0]['Plan']['Plan Rows']), capped), True
+    return capped, True
+
+
+def build_customers_list(user_id, args):
+    query = Customer.query.filter(Customer.user_id == user_id)
+
+    # بدون أي معامل نُبقي الاستجابة القديمة (قائمة كاملة) للتوافق مع الواجهات
+    if not any(key in args for key in ('limit', 'cursor', 'sort', 'q', 'status')):
+        return jsonify([c.to_dict() for c in query.order_by(Customer.customer_id).all()])
+
+    sort = args.get('sort', 'name')
+    status = args.get('status', 'all')
+    if sort not in CUSTOMER_SORTS:
+        return jsonify({"error": "قيمة sort غير صالحة (name أو remaining_debt)."}), 400
+    if status not in CUSTOMER_STATUSES:
+        return jsonify({"error": "قيمة status غير صالحة (all أو unpaid أو paid)."}), 400
+    try:
+        limit = min(max(int(args.get('limit', CUSTOMERS_DEFAULT_PAGE_SIZE)), 1), CUSTOMERS_MAX_PAGE_SIZE)
+        cursor = decode_customers_cursor(args['cursor'], sort) if args.get('cursor') else None
+    except (ValueError, TypeError, InvalidOperation):
+        return jsonify({"error": "قيمة limit أو cursor غير صالحة."}), 400
+
+    # البحث بالبادئة في الاسم أو الهاتف أو البريد: UNION حتى يقرأ كل فرع مدى فهرسه
+    # (OR على الأعمدة الثلاثة يجعل المحرك يمسح كل عملاء المستخدم)
+    q = args.get('q', '').strip()
+    if q:
+        matches = union(*[
+            select(Customer.customer_id).where(Customer.user_id == user_id, prefix_match(column, prefix))
+            for column, prefix in ((CUSTOMER_NAME_LOWER, q.lower()), (Customer.phone, q), (CUSTOMER_EMAIL_LOWER, q.lower()))
+        ])
+        query = query.filter(Customer.customer_id.in_(matches))
+    if status == 'unpaid':
+        query = query.filter(CUSTOMER_REMAINING_DEBT > 0)
+    elif status == 'paid':
+        query = query.filter(CUSTOMER_REMAINING_DEBT <= 0)
+
+    total = estimate_customers_count(query) if cursor is None else None
+
+    # الترقيم بالمؤشر (keyset) على (قيمة الترتيب، customer_id)
+    if sort == 'name':
+        if cursor:
+            last_name, last_id = cursor
+            query = query.filter(db.or_(
+                Customer.name > last_name,
+                db.and_(Customer.name == last_name, Customer.customer_id > last_id)
+            ))
+        query = query.order_by(Customer.name, Customer.customer_id)
+    else:
+        # الأكبر ديناً أولاً، والعملاء بلا أرصدة (NULL) في النهاية
+        if cursor:
+            last_remaining, last_id = cursor
+            if last_remaining is None:
+                query = query.filter(CUSTOMER_REMAINING_DEBT.is_(None), Customer.customer_id < last_id)
+            else:
+                query = query.filter(db.or_(
+                    CUSTOMER_REMAINING_DEBT < last_remaining,
+                    db.and_(CUSTOMER_REMAINING_DEBT == last_remaining, Customer.customer_id < last_id),
+                    CUSTOMER_REMAINING_DEBT.is_(None)
+                ))
+        query = query.order_by(CUSTOMER_REMAINING_DEBT.desc().nulls_last(), Customer.customer_id.desc())
+
+    rows = query.limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    next_cursor = None
+    if has_more:
+        last = rows[-1]
+        if sort == 'name':
+            next_cursor = encode_customers_cursor(last.name, last.customer_id)
+        else:
+            remaining = None if last.total_debt is None or last.total_paid is None else str(last.total_debt - last.total_paid)
+            next_cursor = encode_customers_cursor(remaining, last.customer_id)
+
+    payload = {"items": [c.to_dict() for c in rows], "next_cursor": next_cursor}
+    if total is not None:
+        payload["total"], payload["total_is_estimate"] = total
+    return jsonify(payload)
 
 ### 2.3. تحديث دين العميل (PUT)
 
@@ -804,21 +1512,22 @@ def manage_customer_debt(customer_id):
                 new_debt = Decimal(str(data['new_debt_amount']))
                 if new_debt < 0:
                     return jsonify({"error": "قيمة الدين الجديدة يجب أن تكون موجبة."}), 400
-                # إضافة المبلغ الجديد إلى إجمالي الدين
-                customer.total_debt += new_debt
+                # إضافة المبلغ الجديد إلى إجمالي الدين (قيد + تحديث ذري)
+                post_ledger_entry(customer, 'debt', new_debt, data.get('note'))
                 
             # تسجيل تسديد: يتم إرسال 'payment_amount'
             if 'payment_amount' in data and data['payment_amount'] is not None:
                 payment = Decimal(str(data['payment_amount']))
                 if payment < 0:
                     return jsonify({"error": "قيمة التسديد يجب أن تكون موجبة."}), 400
-                # إضافة المبلغ المسدد إلى إجمالي المسدد
-                customer.total_paid += payment
+                # إضافة المبلغ المسدد إلى إجمالي المسدد (قيد + تحديث ذري)
+                post_ledger_entry(customer, 'payment', payment, data.get('note'))
                 
             # تحديث حقول أخرى (مثل الاسم أو المنتجات) بشكل اختياري
             customer.name = data.get('name', customer.name)
             customer.products_sold_summary = data.get('products_sold_summary', customer.products_sold_summary)
 
+            bump_resource_version('customers', user_id)
             db.session.commit()
             return jsonify({"message": "تم تحديث بيانات الدين/العميل بنجاح.", "customer": customer.to_dict()}), 200
 
@@ -843,6 +1552,7 @@ def delete_customer(customer_id):
 
     try:
         db.session.delete(customer)
+        bump_resource_version('customers', user_id)
         db.session.commit()
         return jsonify({"message": "تم حذف العميل بنجاح."}), 200
     except Exception as e:
@@ -850,6 +1560,320 @@ def delete_customer(customer_id):
         return jsonify({"error": f"فشل حذف العميل: {str(e)}"}), 500
 
 # =========================================================================
+# دفتر ديون العملاء: قيود إلحاق فقط + تحديث ذري للأرصدة + لقطات دورية
+# =========================================================================
+
+LEDGER_ENTRY_TYPES = ('debt', 'payment')
+LEDGER_SNAPSHOT_INTERVAL = int(os.getenv('LEDGER_SNAPSHOT_INTERVAL', 50))
+LEDGER_BACKFILL_BATCH = 1000
+LEDGER_OPENING_NOTE = 'رصيد افتتاحي'
+
+
+def post_ledger_entry(customer, entry_type, amount, note=None):
+    """يسجل قيداً ويحدّث رصيد العميل بـ UPDATE ذري (بدون قراءة ثم كتابة في Python).
+
+    قفل الصف في UPDATE يرتب القيود المتزامنة لنفس العميل، فالأرصدة المعادة بـ RETURNING
+    هي الرصيد الدقيق بعد هذا القيد وتُكتب منها اللقطة عند اكتمال الدورة. لا يقوم بـ commit.
+    """
+    column = Customer.total_debt if entry_type == 'debt' else Customer.total_paid
+    counter = Customer.ledger_entries_since_snapshot + 1
+    total_debt, total_paid, since_snapshot = db.session.execute(
+        update(Customer)
+        .where(Customer.customer_id == customer.customer_id)
+        .values({
+            column: func.coalesce(column, 0) + amount,
+            Customer.ledger_entries_since_snapshot: db.case((counter >= LEDGER_SNAPSHOT_INTERVAL, 0), else_=counter)
+        })
+        .returning(Customer.total_debt, Customer.total_paid, Customer.ledger_entries_since_snapshot)
+        .execution_options(synchronize_session=False)
+    ).one()
+
+    entry = CustomerLedgerEntry(
+        customer_id=customer.customer_id,
+        user_id=customer.user_id,
+        entry_type=entry_type,
+        amount=amount,
+        note=note,
+        created_at=datetime.utcnow()
+    )
+    db.session.add(entry)
+    db.session.flush()
+
+    if since_snapshot == 0:
+        db.session.add(CustomerBalanceSnapshot(
+            customer_id=customer.customer_id,
+            entry_id=entry.entry_id,
+            taken_at=entry.created_at,
+            total_debt=total_debt or 0,
+            total_paid=total_paid or 0
+        ))
+    # القيم المحملة في الجلسة أصبحت قديمة
+    db.session.expire(customer, ['total_debt', 'total_paid', 'ledger_entries_since_snapshot'])
+    return entry
+
+
+def customer_balance_before(customer_id, moment):
+    """رصيد العميل قبل لحظة معينة: أقرب لقطة قبلها + القيود بين اللقطة واللحظة فقط.
+
+    اللقطة التالية (إن وجدت) تقع بعد اللحظة، فالذيل لا يتجاوز LEDGER_SNAPSHOT_INTERVAL قيداً.
+    """
+    snapshot = CustomerBalanceSnapshot.query.filter(
+        CustomerBalanceSnapshot.customer_id == customer_id,
+        CustomerBalanceSnapshot.taken_at < moment
+    ).order_by(CustomerBalanceSnapshot.taken_at.desc(), CustomerBalanceSnapshot.entry_id.desc()).first()
+
+    tail = db.session.query(
+        func.coalesce(func.sum(db.case((CustomerLedgerEntry.entry_type == 'debt', CustomerLedgerEntry.amount), else_=0)), 0),
+        func.coalesce(func.sum(db.case((CustomerLedgerEntry.entry_type == 'payment', CustomerLedgerEntry.amount), else_=0)), 0)
+    ).filter(
+        CustomerLedgerEntry.customer_id == customer_id,
+        CustomerLedgerEntry.created_at < moment
+    )
+    debt, paid = Decimal('0'), Decimal('0')
+    if snapshot:
+        tail = tail.filter(
+            CustomerLedgerEntry.created_at >= snapshot.taken_at,
+            CustomerLedgerEntry.entry_id > snapshot.entry_id
+        )
+        debt, paid = Decimal(snapshot.total_debt), Decimal(snapshot.total_paid)
+    tail_debt, tail_paid = tail.one()
+    return debt + Decimal(tail_debt), paid + Decimal(tail_paid)
+
+
+def serialize_balance(total_debt, total_paid):
+    return {
+        "total_debt": float(total_debt),
+        "total_paid": float(total_paid),
+        "remaining_debt": float(total_debt - total_paid)
+    }
+
+
+def parse_ledger_moment(value):
+    """تاريخ (YYYY-MM-DD) أو تاريخ ووقت ISO 8601، ويُوحَّد إلى UTC بدون منطقة زمنية."""
+    return as_naive_utc(datetime.fromisoformat(value.replace('Z', '+00:00')))
+
+
+# API: رصيد العميل في لحظة معينة (?at=...، والافتراضي الآن)
+@app.route('/api/customers/<int:customer_id>/balance', methods=['GET'])
+def get_customer_balance(customer_id):
+    if 'logged_in' not in session or 'user_id' not in session:
+        return jsonify({"error": "غير مصرح لك بالوصول"}), 401
+
+    customer = Customer.query.filter_by(customer_id=customer_id, user_id=session['user_id']).first()
+    if not customer:
+        return jsonify({"error": "العميل غير موجود أو ليس لديك صلاحية"}), 404
+
+    if not request.args.get('at'):
+        return jsonify(dict(serialize_balance(customer.total_debt or 0, customer.total_paid or 0), customer_id=customer_id)), 200
+    try:
+        moment = parse_ledger_moment(request.args['at'])
+    except ValueError:
+        return jsonify({"error": "تنسيق التاريخ غير صالح (ISO 8601)."}), 400
+
+    total_debt, total_paid = customer_balance_before(customer_id, moment)
+    return jsonify(dict(serialize_balance(total_debt, total_paid), customer_id=customer_id, at=moment.isoformat())), 200
+
+
+# API: كشف حساب العميل لفترة (رصيد افتتاحي + قيود الفترة برصيد جارٍ + رصيد ختامي)
+@app.route('/api/customers/<int:customer_id>/statement', methods=['GET'])
+def get_customer_statement(customer_id):
+    if 'logged_in' not in session or 'user_id' not in session:
+        return jsonify({"error": "غير مصرح لك بالوصول"}), 401
+
+    customer = Customer.query.filter_by(customer_id=customer_id, user_id=session['user_id']).first()
+    if not customer:
+        return jsonify({"error": "العميل غير موجود أو ليس لديك صلاحية"}), 404
+
+    try:
+        end_date = datetime.strptime(request.args['end_date'], '%Y-%m-%d').date() if request.args.get('end_date') else datetime.utcnow().date()
+        start_date = datetime.strptime(request.args['start_date'], '%Y-%m-%d').date() if request.args.get('start_date') else end_date.replace(day=1)
+    except ValueError:
+        return jsonify({"error": "تنسيق التاريخ يجب أن يكون YYYY-MM-DD."}), 400
+    if start_date > end_date:
+        return jsonify({"error": "تاريخ البداية يجب أن يسبق تاريخ النهاية."}), 400
+
+    period_start, period_end = as_naive_utc(start_date), as_naive_utc(end_date + timedelta(days=1))
+    debt, paid = customer_balance_before(customer_id, period_start)
+    opening = serialize_balance(debt, paid)
+
+    entries = CustomerLedgerEntry.query.filter(
+        CustomerLedgerEntry.customer_id == customer_id,
+        CustomerLedgerEntry.created_at >= period_start,
+        CustomerLedgerEntry.created_at < period_end
+    ).order_by(CustomerLedgerEntry.created_at, CustomerLedgerEntry.entry_id).all()
+
+    lines = []
+    for entry in entries:
+        if entry.entry_type == 'debt':
+            debt += entry.amount
+        else:
+            paid += entry.amount
+        lines.append(dict(entry.to_dict(), remaining_debt=float(debt - paid)))
+
+    return jsonify({
+        "customer_id": customer_id,
+        "start_date": start_date.isoformat(),
+        "end_date": end_date.isoformat(),
+        "opening_balance": opening,
+        "entries": lines,
+        "closing_balance": serialize_balance(debt, paid)
+    }), 200
+
+
+# =========================================================================
+# API: أعمار الديون (0-30، 31-60، 61-90، +90 يوماً) وأكبر المدينين
+# =========================================================================
+
+# (التسمية، الحد الأعلى للعمر بالأيام) والفئة الأخيرة مفتوحة
+AGING_BUCKETS = (('0-30', 30), ('31-60', 60), ('61-90', 90), ('90+', None))
+AGING_TOP_DEBTORS = 10
+
+
+def receivables_aging(user_id, now):
+    """يوزع الرصيد المتبقي لكل عميل على قيود الدين الأحدث (التسديدات تغطي الأقدم أولاً - FIFO)
+    ويجمّع المبالغ حسب عمر القيد، في استعلام GROUP BY واحد.
+
+    يعيد {رقم الفئة: (المبلغ، عدد العملاء)}.
+    """
+    entry = CustomerLedgerEntry
+    # الدين المسجل بعد هذا القيد لنفس العميل (مجموع تراكمي من الأحدث للأقدم)
+    later_debt = func.coalesce(func.sum(entry.amount).over(
+        partition_by=entry.customer_id,
+        order_by=(entry.created_at.desc(), entry.entry_id.desc()),
+        rows=(None, -1)
+    ), 0)
+    debts = select(
+        entry.customer_id,
+        entry.created_at,
+        entry.amount,
+        (CUSTOMER_REMAINING_DEBT - later_debt).label('uncovered')
+    ).join(Customer, Customer.customer_id == entry.customer_id).where(
+        Customer.user_id == user_id,
+        CUSTOMER_REMAINING_DEBT > 0,
+        entry.entry_type == 'debt'
+    ).subquery()
+
+    # الجزء غير المسدد من القيد: بين 0 وقيمة القيد
+    outstanding = db.case(
+        (debts.c.uncovered <= 0, 0),
+        (debts.c.uncovered >= debts.c.amount, debts.c.amount),
+        else_=debts.c.uncovered
+    )
+    bucket = db.case(
+        *[(debts.c.created_at >= now - timedelta(days=days), index)
+          for index, (_, days) in enumerate(AGING_BUCKETS) if days is not None],
+        else_=len(AGING_BUCKETS) - 1
+    ).label('bucket')
+    rows = db.session.execute(
+        select(bucket, func.sum(outstanding), func.count(debts.c.customer_id.distinct()))
+        .where(debts.c.uncovered > 0)
+        .group_by(bucket)
+    ).all()
+    return {index: (amount, customers) for index, amount, customers in rows}
+
+
+@app.route('/api/customers/aging', methods=['GET'])
+def get_customers_aging():
+    if 'logged_in' not in session or 'user_id' not in session:
+        return jsonify({"error": "غير مصرح لك بالوصول"}), 401
+
+    user_id = session['user_id']
+    try:
+        limit = min(max(int(request.args.get('top', AGING_TOP_DEBTORS)), 1), 100)
+    except ValueError:
+        return jsonify({"error": "قيمة top يجب أن تكون رقماً صحيحاً."}), 400
+    today = datetime.utcnow().date()
+
+    def compute():
+        # عبارتان عن قصد: الفئات تُجمّع قيود الدفتر (customer_ledger_entries) والإجماليات وأكبر المدينين
+        # تقرأ نطاق فهرس العملاء (user_id, المتبقي)؛ كل منهما مسح لنطاق فهرس واحد للمستخدم،
+        # ودمجهما في عبارة واحدة يحتاج UNION لصفوف مختلفة الشكل دون توفير أي قراءة
+        buckets = receivables_aging(user_id, as_naive_utc(today))
+
+        # أكبر المدينين مع الإجماليات في عبارة واحدة: دوال النافذة تُحسب على كل المدينين قبل LIMIT،
+        # والقراءة من نطاق الفهرس (user_id, المتبقي) فقط
+        top = db.session.execute(
+            select(
+                Customer.customer_id, Customer.name, Customer.phone,
+                CUSTOMER_REMAINING_DEBT.label('remaining_debt'),
+                func.count().over().label('debtors'),
+                func.sum(CUSTOMER_REMAINING_DEBT).over().label('total_outstanding')
+            ).where(
+                Customer.user_id == user_id, CUSTOMER_REMAINING_DEBT > 0
+            ).order_by(CUSTOMER_REMAINING_DEBT.desc()).limit(limit)
+        ).all()
+
+        debtors = top[0].debtors if top else 0
+        total_outstanding = float(top[0].total_outstanding) if top else 0.0
+        aged = sum(float(amount or 0) for amount, _ in buckets.values())
+        return {
+            "as_of": today.isoformat(),
+            "total_outstanding": round(total_outstanding, 2),
+            "debtors": debtors,
+            # أرصدة بلا قيود دين في الدفتر (عملاء قدامى قبل backfill_customer_ledger)
+            "unaged": round(max(total_outstanding - aged, 0), 2),
+            "buckets": [
+                {
+                    "label": label,
+                    "amount": round(float(buckets.get(index, (0, 0))[0] or 0), 2),
+                    "customers": buckets.get(index, (0, 0))[1]
+                }
+                for index, (label, _) in enumerate(AGING_BUCKETS)
+            ],
+            "top_debtors": [
+                {
+                    "customer_id": row.customer_id,
+                    "name": row.name,
+                    "phone": row.phone,
+                    "remaining_debt": round(float(row.remaining_debt), 2)
+                }
+                for row in top
+            ]
+        }
+
+    payload = report_cache.get_or_compute(
+        'customer_aging', user_id, [('customers', user_id)],
+        {"today": today, "top": limit},
+        compute
+    )
+    return jsonify(payload), 200
+
+
+@app.cli.command("backfill_customer_ledger")
+@click.option("--batch-size", type=int, default=LEDGER_BACKFILL_BATCH)
+def backfill_customer_ledger(batch_size):
+    """يكتب قيوداً افتتاحية بأرصدة العملاء الحاليين الذين ليس لهم قيود بعد، على دفعات."""
+    has_entries = select(CustomerLedgerEntry.entry_id).where(
+        CustomerLedgerEntry.customer_id == Customer.customer_id
+    ).exists()
+    last_id, written = 0, 0
+    while True:
+        customers = db.session.execute(
+            select(Customer.customer_id, Customer.user_id, Customer.total_debt, Customer.total_paid)
+            .where(Customer.customer_id > last_id, ~has_entries)
+            .order_by(Customer.customer_id)
+            .limit(batch_size)
+        ).all()
+        if not customers:
+            break
+        now = datetime.utcnow()
+        rows = [
+            {"customer_id": customer_id, "user_id": user_id, "entry_type": entry_type,
+             "amount": amount, "note": LEDGER_OPENING_NOTE, "created_at": now}
+            for customer_id, user_id, total_debt, total_paid in customers
+            for entry_type, amount in (('debt', total_debt), ('payment', total_paid))
+            if amount
+        ]
+        if rows:
+            db.session.execute(insert(CustomerLedgerEntry), rows)
+        for owner_id in {row["user_id"] for row in rows}:
+            bump_resource_version('customers', owner_id)
+        db.session.commit()
+        written += len(rows)
+        last_id = customers[-1].customer_id
+    print(f"تم تسجيل {written} قيد افتتاحي.")
+
+# =========================================================================
 
 
 # مسار لإظهار صفحة comparisons.html
@@ -890,47 +1914,391 @@ def create_super_admin_command():
 # مسارات API للواجهة الأمامية
 # =========================================================================
 
-# API: جلب جميع المنتجات
-@app.route('/api/products', methods=['GET'])
-def get_products():
+# =========================================================================
+# ذاكرة مؤقتة (LRU) لعمليات البحث بالباركود لكل مستخدم
+# =========================================================================
+
+class BarcodeCache:
+    """ذاكرة مؤقتة محدودة الحجم داخل العملية: (المستخدم، الباركود) -> بيانات المنتج."""
+
+    def __init__(self, max_tenants=256, max_items_per_tenant=2000):
+        self.max_tenants = max_tenants
+        self.max_items_per_tenant = max_items_per_tenant
+        self._tenants = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, barcode):
+        with self._lock:
+            items = self._tenants.get(user_id)
+            if items is None or barcode not in items:
+                return None
+            self._tenants.move_to_end(user_id)
+            items.move_to_end(barcode)
+            return items[barcode]
+
+    def set(self, user_id, barcode, product_dict):
+        with self._lock:
+            items = self._tenants.get(user_id)
+            if items is None:
+                items = self._tenants[user_id] = OrderedDict()
+            self._tenants.move_to_end(user_id)
+            items[barcode] = product_dict
+            items.move_to_end(barcode)
+            # إخراج الأقدم استخداماً عند تجاوز الحدود
+            while len(items) > self.max_items_per_tenant:
+                items.popitem(last=False)
+            while len(self._tenants) > self.max_tenants:
+                self._tenants.popitem(last=False)
+
+    def discard(self, user_id, *barcodes):
+        with self._lock:
+            items = self._tenants.get(user_id)
+            if items is None:
+                return
+            for barcode in barcodes:
+                if barcode:
+                    items.pop(barcode, None)
+
+    def invalidate_tenant(self, user_id):
+        with self._lock:
+            self._tenants.pop(user_id, None)
+
+
+barcode_cache = BarcodeCache()
+
+
+def discard_cached_products(products):
+    """يحذف المنتجات المعدلة من ذاكرة الباركود المؤقتة (بعد نجاح commit)."""
+    for product in products:
+        if product is not None and product.barcode:
+            barcode_cache.discard(product.user_id, product.barcode)
+
+
+PRODUCT_CHANGES_MAX_PAGE_SIZE = 1000
+
+
+# API: تغييرات المنتجات منذ رمز مزامنة سابق (مزامنة تزايدية لنقاط البيع)
+@app.route('/api/products/changes', methods=['GET'])
+def get_product_changes():
     if 'logged_in' not in session or 'user_id' not in session:
         return jsonify({"error": "غير مصرح لك بالوصول"}), 401
 
     user_id = session['user_id']
-    products = Product.query.filter_by(user_id=user_id).all()
-    return jsonify([p.to_dict() for p in products])
 
-# API: إضافة منتج جديد
-@app.route('/api/products', methods=['POST'])
-def add_product():
-    # Check if a user is logged in before allowing them to add a product
+    try:
+        limit = min(max(int(request.args.get('limit', PRODUCT_CHANGES_MAX_PAGE_SIZE)), 1), PRODUCT_CHANGES_MAX_PAGE_SIZE)
+        since = int(request.args['since']) if request.args.get('since') else None
+    except ValueError:
+        return jsonify({"error": "قيمة since أو limit غير صالحة."}), 400
+
+    if since is None:
+        # أول مزامنة: يجلب العميل القائمة كاملة من /api/products ثم يتابع من هذا الرمز
+        current = db.session.query(func.max(ProductChange.change_id)).filter(
+            ProductChange.user_id == user_id
+        ).scalar() or 0
+        return jsonify({"full_sync": True, "next_token": str(current), "products": [], "deleted": [], "has_more": False})
+
+    changes = db.session.query(ProductChange.change_id, ProductChange.product_id, ProductChange.deleted).filter(
+        ProductChange.user_id == user_id,
+        ProductChange.change_id > since
+    ).order_by(ProductChange.change_id).limit(limit + 1).all()
+
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    if not changes:
+        return jsonify({"full_sync": False, "next_token": str(since), "products": [], "deleted": [], "has_more": False})
+
+    # آخر حالة لكل منتج خلال هذه الصفحة هي ما يهم
+    latest = {}
+    for change in changes:
+        latest[change.product_id] = change.deleted
+
+    updated_ids = [pid for pid, deleted in latest.items() if not deleted]
+    products = Product.query.filter(Product.user_id == user_id, Product.id.in_(updated_ids)).all() if updated_ids else []
+    found = {p.id for p in products}
+
+    return jsonify({
+        "full_sync": False,
+        "next_token": str(changes[-1].change_id),
+        "products": [p.to_dict() for p in products],
+        # منتج عُدّل ثم حُذف لاحقاً (خارج هذه الصفحة) يظهر كحذف أيضاً
+        "deleted": sorted(pid for pid, deleted in latest.items() if deleted or pid not in found),
+        "has_more": has_more
+    })
+
+
+# API: جلب منتج بالباركود (لنقاط البيع)
+@app.route('/api/products/by-barcode/<string:barcode>', methods=['GET'])
+def get_product_by_barcode(barcode):
+    if 'logged_in' not in session or 'user_id' not in session:
+        return jsonify({"error": "غير مصرح لك بالوصول"}), 401
+
+    user_id = session['user_id']
+
+    cached = barcode_cache.get(user_id, barcode)
+    if cached is not None:
+        return jsonify(cached), 200
+
+    # بحث واحد عبر الفهرس (user_id, barcode)
+    product = Product.query.filter_by(user_id=user_id, barcode=barcode).first()
+    if not product:
+        return jsonify({"error": "المنتج غير موجود."}), 404
+
+    product_dict = product.to_dict()
+    barcode_cache.set(user_id, barcode, product_dict)
+    return jsonify(product_dict), 200
+
+# الأعمدة المسموح بطلبها عبر ?fields= في قائمة المنتجات
+PRODUCT_FIELDS = (
+    'id', 'name', 'barcode', 'code', 'category', 'image_url', 'quantity_in_stock',
+    'cost_price', 'wholesale_price', 'retail_price', 'supplier'
+)
+PRODUCT_PRICE_FIELDS = {'cost_price', 'wholesale_price', 'retail_price'}
+PRODUCTS_MAX_PAGE_SIZE = 500
+LOW_STOCK_THRESHOLD = 10
+
+
+def serialize_product_row(row, fields):
+    """يحول صفاً مُسقطاً (أعمدة محددة فقط) إلى قاموس بنفس تنسيق Product.to_dict."""
+    data = {}
+    for field in fields:
+        value = getattr(row, field)
+        if field in PRODUCT_PRICE_FIELDS and value is not None:
+            value = float(value)
+        data[field] = value
+    return data
+
+
+# API: جلب المنتجات (مع ترقيم بالمؤشر، اختيار الحقول، والفلترة)
+@app.route('/api/products', methods=['GET'])
+def get_products():
     if 'logged_in' not in session or 'user_id' not in session:
         return jsonify({"error": "غير مصرح لك بالوصول"}), 401
 
+    user_id = session['user_id']
+    return conditional_list_response('products', user_id, lambda: build_products_list(user_id, request.args))
+
+
+def build_products_list(user_id, args):
+    query = Product.query.filter(Product.user_id == user_id)
+
+    # الفلترة من جهة الخادم
+    if args.get('category'):
+        query = query.filter(Product.category == args['category'])
+    if args.get('supplier'):
+        query = query.filter(Product.supplier == args['supplier'])
+    if args.get('low_stock', '').lower() in ('1', 'true', 'yes'):
+        try:
+            threshold = int(args.get('threshold', LOW_STOCK_THRESHOLD))
+        except ValueError:
+            return jsonify({"error": "قيمة حد المخزون المنخفض غير صالحة."}), 400
+        query = query.filter(Product.quantity_in_stock < threshold)
+
+    # اختيار الحقول: نجلب الأعمدة المطلوبة فقط بدل الكائن الكامل
+    fields = None
+    if args.get('fields'):
+        fields = [f.strip() for f in args['fields'].split(',') if f.strip()]
+        unknown = [f for f in fields if f not in PRODUCT_FIELDS]
+        if unknown:
+            return jsonify({"error": f"حقول غير معروفة: {', '.join(unknown)}"}), 400
+        if 'id' not in fields:
+            fields.insert(0, 'id')
+        query = query.with_entities(*[getattr(Product, f) for f in fields])
+
+    def serialize(rows):
+        if fields:
+            return [serialize_product_row(r, fields) for r in rows]
+        return [p.to_dict() for p in rows]
+
+    # بدون limit/cursor نُبقي الاستجابة القديمة (قائمة كاملة) للتوافق مع الواجهات
+    if 'limit' not in args and 'cursor' not in args:
+        return jsonify(serialize(query.order_by(Product.id).all()))
+
+    # الترقيم بالمؤشر (keyset) على id: لا OFFSET ولا مسح للصفوف السابقة
     try:
-        data = request.get_json()
-        user_id = session['user_id'] # Retrieve the current user's ID from the session
-        
-        # Ensure all required fields are present
-        required_fields = ['name', 'quantity_in_stock', 'cost_price']
-        if not all(field in data for field in required_fields):
-            return jsonify({"error": "بيانات المنتج غير مكتملة."}), 400
+        limit = min(max(int(args.get('limit', 100)), 1), PRODUCTS_MAX_PAGE_SIZE)
+        cursor = int(args['cursor']) if args.get('cursor') else None
+    except ValueError:
+        return jsonify({"error": "قيمة limit أو cursor غير صالحة."}), 400
 
-        new_product = Product(
-            name=data['name'],
-            barcode=data.get('barcode'),
-            code=data.get('code'),
-            category=data.get('category'),
-            image_url=data.get('image_url'),
-            quantity_in_stock=data['quantity_in_stock'],
-            cost_price=data['cost_price'],
+    if cursor is not None:
+        query = query.filter(Product.id > cursor)
+    rows = query.order_by(Product.id).limit(limit + 1).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return jsonify({
+        "items": serialize(rows),
+        "next_cursor": str(rows[-1].id) if has_more else None
+    })
+
+# =========================================================================
+# فهرس البحث في المنتجات (FTS5 على SQLite و pg_trgm على Postgres)
+# =========================================================================
+
+PRODUCT_SEARCH_MAX_RESULTS = 50
+# محرك الفهرس trigram يحتاج 3 أحرف على الأقل، ما دونها نبحث بـ LIKE داخل منتجات المستخدم
+PRODUCT_SEARCH_MIN_TRIGRAM = 3
+
+SQLITE_PRODUCT_SEARCH_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+        name, code, barcode, category,
+        content='products', content_rowid='id', tokenize='trigram'
+    )""",
+    # القوادح تُبقي الفهرس متزامناً مع كل كتابة على جدول المنتجات
+    """CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts(rowid, name, code, barcode, category)
+        VALUES (new.id, new.name, new.code, new.barcode, new.category);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name, code, barcode, category)
+        VALUES ('delete', old.id, old.name, old.code, old.barcode, old.category);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE OF name, code, barcode, category ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name, code, barcode, category)
+        VALUES ('delete', old.id, old.name, old.code, old.barcode, old.category);
+        INSERT INTO products_fts(rowid, name, code, barcode, category)
+        VALUES (new.id, new.name, new.code, new.barcode, new.category);
+    END""",
+    "INSERT INTO products_fts(products_fts) VALUES ('rebuild')",
+]
+
+# نص البحث الموحد على Postgres (يجب أن يطابق تعبير الفهرس حرفياً)
+POSTGRES_PRODUCT_SEARCH_EXPR = (
+    "(coalesce(name, '') || ' ' || coalesce(code, '') || ' ' || "
+    "coalesce(barcode, '') || ' ' || coalesce(category, ''))"
+)
+
+POSTGRES_PRODUCT_SEARCH_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    f"CREATE INDEX IF NOT EXISTS ix_products_search_trgm ON products "
+    f"USING gin ({POSTGRES_PRODUCT_SEARCH_EXPR} gin_trgm_ops)",
+]
+
+PRODUCT_SEARCH_COLUMNS = ', '.join(f'p.{f}' for f in PRODUCT_FIELDS)
+
+
+def setup_product_search_index():
+    """ينشئ فهرس البحث المناسب لنوع قاعدة البيانات (يمكن استدعاؤها أكثر من مرة)."""
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        statements = SQLITE_PRODUCT_SEARCH_DDL
+    elif dialect == 'postgresql':
+        statements = POSTGRES_PRODUCT_SEARCH_DDL
+    else:
+        return
+    with db.engine.begin() as conn:
+        for statement in statements:
+            conn.execute(text(statement))
+
+
+def search_products_fallback(user_id, q, limit):
+    """بحث جزئي بـ LIKE عند غياب الفهرس أو لعبارات أقصر من 3 أحرف (مقيد بمنتجات المستخدم)."""
+    pattern = f"%{q}%"
+    columns = [Product.name, Product.code, Product.barcode, Product.category]
+    return Product.query.with_entities(*[getattr(Product, f) for f in PRODUCT_FIELDS]).filter(
+        Product.user_id == user_id,
+        db.or_(*[c.ilike(pattern) for c in columns])
+    ).order_by(
+        # المطابقة التامة للباركود/الكود أولاً ثم بالاسم
+        db.case((db.or_(Product.barcode == q, Product.code == q), 0), else_=1),
+        Product.name
+    ).limit(limit).all()
+
+
+def search_products(user_id, q, limit):
+    dialect = db.engine.dialect.name
+    if len(q) < PRODUCT_SEARCH_MIN_TRIGRAM:
+        return search_products_fallback(user_id, q, limit)
+
+    params = {"user_id": user_id, "limit": limit}
+    if dialect == 'sqlite':
+        # عبارة FTS5 بين علامتي تنصيص: مطابقة جزئية (substring) عبر trigram
+        params["q"] = '"' + q.replace('"', '""') + '"'
+        sql = f"""
+            SELECT {PRODUCT_SEARCH_COLUMNS}
+            FROM products_fts JOIN products p ON p.id = products_fts.rowid
+            WHERE products_fts MATCH :q AND p.user_id = :user_id
+            ORDER BY (p.barcode = :raw OR p.code = :raw) DESC, bm25(products_fts)
+            LIMIT :limit
+        """
+        params["raw"] = q
+    elif dialect == 'postgresql':
+        params["q"] = q
+        params["pattern"] = '%' + q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        sql = f"""
+            SELECT {PRODUCT_SEARCH_COLUMNS}
+            FROM products p
+            WHERE p.user_id = :user_id AND {POSTGRES_PRODUCT_SEARCH_EXPR} ILIKE :pattern
+            ORDER BY (p.barcode = :q OR p.code = :q) DESC,
+                     similarity({POSTGRES_PRODUCT_SEARCH_EXPR}, :q) DESC
+            LIMIT :limit
+        """
+    else:
+        return search_products_fallback(user_id, q, limit)
+
+    try:
+        return db.session.execute(text(sql), params).all()
+    except (OperationalError, ProgrammingError):
+        # الفهرس غير منشأ بعد (شغّل flask create_db)
+        db.session.rollback()
+        return search_products_fallback(user_id, q, limit)
+
+
+# API: البحث في المنتجات بالاسم/الكود/الباركود/الفئة
+@app.route('/api/products/search', methods=['GET'])
+def search_products_api():
+    if 'logged_in' not in session or 'user_id' not in session:
+        return jsonify({"error": "غير مصرح لك بالوصول"}), 401
+
+    user_id = session['user_id']
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify([])
+
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), PRODUCT_SEARCH_MAX_RESULTS)
+    except ValueError:
+        return jsonify({"error": "قيمة limit غير صالحة."}), 400
+
+    rows = search_products(user_id, q, limit)
+    return jsonify([serialize_product_row(r, PRODUCT_FIELDS) for r in rows])
+
+# API: إضافة منتج جديد
+@app.route('/api/products', methods=['POST'])
+@idempotent('products')
+def add_product():
+    # Check if a user is logged in before allowing them to add a product
+    if 'logged_in' not in session or 'user_id' not in session:
+        return jsonify({"error": "غير مصرح لك بالوصول"}), 401
+
+    try:
+        data = request.get_json()
+        user_id = session['user_id'] # Retrieve the current user's ID from the session
+        
+        # Ensure all required fields are present
+        required_fields = ['name', 'quantity_in_stock', 'cost_price']
+        if not all(field in data for field in required_fields):
+            return jsonify({"error": "بيانات المنتج غير مكتملة."}), 400
+
+        new_product = Product(
+            name=data['name'],
+            barcode=data.get('barcode'),
+            code=data.get('code'),
+            category=data.get('category'),
+            image_url=data.get('image_url'),
+            quantity_in_stock=data['quantity_in_stock'],
+            cost_price=data['cost_price'],
             wholesale_price=data.get('wholesale_price'),
             retail_price=data.get('retail_price'),
             supplier=data.get('supplier'),
             user_id=user_id # **Associate the product with the user ID**
         )
         db.session.add(new_product)
+        db.session.flush()
+        record_product_changes(user_id, [new_product.id])
         db.session.commit()
+        barcode_cache.discard(user_id, new_product.barcode)
         return jsonify(new_product.to_dict()), 201
     
     except IntegrityError:
@@ -939,6 +2307,228 @@ def add_product():
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": "حدث خطأ غير متوقع: " + str(e)}), 500
+# =========================================================================
+# استيراد المنتجات بالجملة (CSV / JSONL) على دفعات
+# =========================================================================
+
+PRODUCT_IMPORT_BATCH_SIZE = 1000
+# حد أقصى لعدد أخطاء الصفوف المُعادة حتى تبقى الذاكرة ثابتة مع الملفات الضخمة
+PRODUCT_IMPORT_MAX_REPORTED_ERRORS = 1000
+
+
+def iter_import_records(stream, file_format):
+    """يقرأ السجلات من ملف نصي سطراً بسطر دون تحميله كاملاً في الذاكرة."""
+    if file_format == 'csv':
+        for record in csv.DictReader(stream):
+            yield record
+    elif file_format == 'jsonl':
+        for line in stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+    else:
+        raise ValueError(f"صيغة غير مدعومة: {file_format}")
+
+
+def validate_import_record(record, user_id):
+    """يحول سجلاً خاماً إلى قيم جاهزة للإدراج أو يرفع ValueError برسالة الخطأ."""
+    if not isinstance(record, dict):
+        raise ValueError("سطر غير صالح")
+
+    def clean(key):
+        value = record.get(key)
+        if isinstance(value, str):
+            value = value.strip()
+        return value if value not in ('', None) else None
+
+    def price(key, required=False):
+        value = clean(key)
+        if value is None:
+            if required:
+                raise ValueError(f"الحقل {key} إلزامي")
+            return None
+        try:
+            value = Decimal(str(value))
+        except InvalidOperation:
+            raise ValueError(f"قيمة {key} غير صالحة")
+        if value < 0:
+            raise ValueError(f"قيمة {key} يجب أن تكون موجبة")
+        return value
+
+    name = clean('name')
+    if not name:
+        raise ValueError("اسم المنتج إلزامي")
+    try:
+        quantity = int(clean('quantity_in_stock') or 0)
+    except (TypeError, ValueError):
+        raise ValueError("الكمية يجب أن تكون رقماً صحيحاً")
+    if quantity < 0:
+        raise ValueError("الكمية يجب أن تكون موجبة")
+
+    barcode = clean('barcode')
+    return {
+        'user_id': user_id,
+        'name': name,
+        'barcode': str(barcode) if barcode is not None else None,
+        'code': clean('code'),
+        'category': clean('category'),
+        'image_url': clean('image_url'),
+        'quantity_in_stock': quantity,
+        'cost_price': price('cost_price', required=True),
+        'wholesale_price': price('wholesale_price'),
+        'retail_price': price('retail_price'),
+        'supplier': clean('supplier'),
+    }
+
+
+def insert_product_batch(batch):
+    """يدرج دفعة (رقم الصف، القيم) بعبارة واحدة ويعيد الصفوف المرفوضة."""
+    errors = []
+
+    # استبعاد الباركود المكرر مسبقاً في قاعدة البيانات باستعلام واحد للدفعة
+    barcodes = [values['barcode'] for _, values in batch if values['barcode']]
+    existing = set()
+    if barcodes:
+        existing = {b for (b,) in db.session.query(Product.barcode).filter(Product.barcode.in_(barcodes))}
+
+    rows = []
+    for row_number, values in batch:
+        if values['barcode'] in existing:
+            errors.append((row_number, "الباركود موجود بالفعل"))
+            continue
+        if values['barcode']:
+            existing.add(values['barcode'])
+        rows.append((row_number, values))
+
+    if not rows:
+        return 0, errors
+
+    try:
+        with db.session.begin_nested():
+            db.session.execute(insert(Product), [values for _, values in rows])
+        return len(rows), errors
+    except IntegrityError:
+        # تعارض نادر (كتابة متزامنة): نعيد المحاولة صفاً صفاً لتحديد الصف المسبب فقط
+        inserted = 0
+        for row_number, values in rows:
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(insert(Product), [values])
+                inserted += 1
+            except IntegrityError:
+                errors.append((row_number, "الباركود موجود بالفعل"))
+        return inserted, errors
+
+
+def import_products_from_stream(stream, file_format, user_id, batch_size=PRODUCT_IMPORT_BATCH_SIZE):
+    """يستورد المنتجات من ملف نصي على دفعات، مع commit بعد كل دفعة."""
+    inserted = 0
+    failed = 0
+    errors = []
+    batch = []
+
+    def report(row_number, message):
+        nonlocal failed
+        failed += 1
+        if len(errors) < PRODUCT_IMPORT_MAX_REPORTED_ERRORS:
+            errors.append({"row": row_number, "error": message})
+
+    def flush():
+        nonlocal inserted
+        last_id = db.session.query(func.max(Product.id)).filter(Product.user_id == user_id).scalar() or 0
+        batch_inserted, batch_errors = insert_product_batch(batch)
+        if batch_inserted:
+            # تسجيل المنتجات المُدرجة في سجل المزامنة بعبارة INSERT ... SELECT واحدة
+            db.session.execute(insert(ProductChange).from_select(
+                ['user_id', 'product_id', 'deleted'],
+                select(Product.user_id, Product.id, literal(False)).where(
+                    Product.user_id == user_id, Product.id > last_id
+                ).order_by(Product.id)
+            ))
+            bump_resource_version('products', user_id)
+        db.session.commit()
+        inserted += batch_inserted
+        for row_number, message in batch_errors:
+            report(row_number, message)
+        batch.clear()
+
+    for row_number, record in enumerate(iter_import_records(stream, file_format), start=1):
+        try:
+            batch.append((row_number, validate_import_record(record, user_id)))
+        except ValueError as e:
+            report(row_number, str(e))
+            continue
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    return {"inserted": inserted, "failed": failed, "errors": errors}
+
+
+def detect_import_format(filename, explicit=None):
+    if explicit:
+        return explicit.lower()
+    if filename and filename.lower().endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    return 'csv'
+
+
+# API: استيراد المنتجات بالجملة من ملف CSV أو JSONL
+@app.route('/api/products/import', methods=['POST'])
+def import_products_api():
+    if 'logged_in' not in session or 'user_id' not in session:
+        return jsonify({"error": "غير مصرح لك بالوصول"}), 401
+
+    user_id = session['user_id']
+
+    # الملف المرفوع يُحفظ مؤقتاً على القرص بواسطة Werkzeug ونقرؤه كتدفق
+    upload = request.files.get('file')
+    if upload:
+        raw = upload.stream
+        file_format = detect_import_format(upload.filename, request.args.get('format'))
+    else:
+        raw = request.stream
+        file_format = detect_import_format(None, request.args.get('format'))
+
+    if file_format not in ('csv', 'jsonl'):
+        return jsonify({"error": "صيغة الملف يجب أن تكون csv أو jsonl."}), 400
+
+    try:
+        stream = io.TextIOWrapper(raw, encoding='utf-8-sig', newline='')
+        result = import_products_from_stream(stream, file_format, user_id)
+    except (UnicodeDecodeError, csv.Error) as e:
+        db.session.rollback()
+        return jsonify({"error": f"تعذر قراءة الملف: {str(e)}"}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": "حدث خطأ غير متوقع: " + str(e)}), 500
+
+    return jsonify(result), 200
+
+
+@app.cli.command("import_products")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--user-id", type=int, required=True, help="معرّف المستخدم المالك للمنتجات.")
+@click.option("--format", "file_format", type=click.Choice(['csv', 'jsonl']), default=None)
+@click.option("--batch-size", type=int, default=PRODUCT_IMPORT_BATCH_SIZE)
+def import_products_command(path, user_id, file_format, batch_size):
+    """يستورد المنتجات من ملف CSV أو JSONL على دفعات."""
+    if db.session.get(User, user_id) is None:
+        raise click.ClickException(f"المستخدم {user_id} غير موجود.")
+
+    file_format = detect_import_format(path, file_format)
+    with open(path, encoding='utf-8-sig', newline='') as stream:
+        result = import_products_from_stream(stream, file_format, user_id, batch_size)
+
+    print(f"تم استيراد {result['inserted']} منتج، وفشل {result['failed']} صف.")
+    for error in result['errors']:
+        print(f"  صف {error['row']}: {error['error']}")
+
 # API: تحديث منتج موجود
 @app.route('/api/products/<int:id>', methods=['PUT'])
 def update_product(id):
@@ -957,6 +2547,7 @@ def update_product(id):
             return jsonify({"error": "المنتج غير موجود أو ليس لديك صلاحية لتعديله."}), 404
 
         data = request.get_json()
+        old_barcode = product.barcode
         
         # تحديث الحقول
         product.name = data.get('name', product.name)
@@ -970,7 +2561,9 @@ def update_product(id):
         product.retail_price = data.get('retail_price', product.retail_price)
         product.supplier = data.get('supplier', product.supplier)
 
+        record_product_changes(user_id, [product.id])
         db.session.commit()
+        barcode_cache.discard(user_id, old_barcode, product.barcode)
         return jsonify(product.to_dict()), 200
     
     except IntegrityError:
@@ -981,6 +2574,65 @@ def update_product(id):
     
     return jsonify({"error": "حدث خطأ غير متوقع: " + str(e)}), 500
 
+# API: تعديل مخزون عدة منتجات دفعة واحدة (مثل إرجاع محتويات السلة)
+@app.route('/api/products/stock-adjustments', methods=['POST'])
+def adjust_stock():
+    if 'logged_in' not in session or 'user_id' not in session:
+        return jsonify({"error": "غير مصرح لك بالوصول"}), 401
+
+    user_id = session['user_id']
+    data = request.get_json(silent=True) or {}
+    adjustments = data.get('adjustments') if isinstance(data, dict) else data
+    if not isinstance(adjustments, list) or not adjustments:
+        return jsonify({"error": "قائمة التعديلات فارغة أو غير صالحة."}), 400
+
+    # دمج التعديلات على نفس المنتج في قيمة واحدة
+    deltas = {}
+    try:
+        for adj in adjustments:
+            product_id = int(adj['product_id'])
+            deltas[product_id] = deltas.get(product_id, 0) + int(adj['delta'])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "كل تعديل يجب أن يحتوي على product_id و delta صحيحين."}), 400
+
+    results = []
+    barcodes = []
+    try:
+        # ترتيب ثابت للمعرّفات لتجنب الـ deadlock بين الطلبات المتزامنة
+        for product_id in sorted(deltas):
+            delta = deltas[product_id]
+            # تحديث ذري مع شرط عدم النزول تحت الصفر (لا قراءة ثم كتابة)
+            row = db.session.execute(
+                update(Product)
+                .where(
+                    Product.id == product_id,
+                    Product.user_id == user_id,
+                    Product.quantity_in_stock + delta >= 0
+                )
+                .values(quantity_in_stock=Product.quantity_in_stock + delta)
+                .returning(Product.id, Product.quantity_in_stock, Product.barcode)
+                .execution_options(synchronize_session=False)
+            ).first()
+
+            if row is None:
+                db.session.rollback()
+                exists = db.session.query(Product.id).filter_by(id=product_id, user_id=user_id).first()
+                if not exists:
+                    return jsonify({"error": f"المنتج {product_id} غير موجود أو ليس لديك صلاحية."}), 404
+                return jsonify({"error": f"الكمية غير متوفرة للمنتج {product_id}", "product_id": product_id}), 409
+
+            results.append({"id": row.id, "quantity_in_stock": row.quantity_in_stock})
+            barcodes.append(row.barcode)
+
+        record_product_changes(user_id, [r["id"] for r in results])
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": "حدث خطأ غير متوقع: " + str(e)}), 500
+
+    barcode_cache.discard(user_id, *barcodes)
+    return jsonify({"products": results}), 200
+
 # API: حذف منتج
 @app.route('/api/products/<int:id>', methods=['DELETE'])
 def delete_product(id):
@@ -1000,65 +2652,310 @@ def delete_product(id):
             return jsonify({"error": "المنتج غير موجود أو ليس لديك صلاحية لحذفه."}), 404
 
         # الخطوة 4: إذا تم العثور على المنتج، قم بحذفه من قاعدة البيانات
+        barcode = product.barcode
         db.session.delete(product)
+        record_product_changes(user_id, [id], deleted=True)
         db.session.commit()
+        barcode_cache.discard(user_id, barcode)
         return jsonify({"message": "تم حذف المنتج بنجاح."}), 200
     
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": "حدث خطأ غير متوقع: " + str(e)}), 500
     
+# =========================================================================
+# محرك البيع: تحميل المنتجات دفعة واحدة وخصم المخزون بعبارة واحدة مشروطة
+# =========================================================================
+
+class SaleError(ValueError):
+    """خطأ في بيانات عملية البيع يُعاد للواجهة برسالة ورمز حالة."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def aggregate_cart(cart_items):
+    """يدمج أسطر السلة لنفس المنتج ويعيد {product_id: الكمية} مع الأسطر المنظفة."""
+    if not isinstance(cart_items, list) or not cart_items:
+        raise SaleError("سلة المشتريات فارغة.")
+    lines = []
+    quantities = {}
+    for item in cart_items:
+        try:
+            product_id = int(item['id'])
+            quantity = int(item['quantity'])
+        except (KeyError, TypeError, ValueError):
+            raise SaleError("بيانات عنصر السلة غير صالحة.")
+        if quantity <= 0:
+            raise SaleError("الكمية يجب أن تكون موجبة.")
+        lines.append((product_id, quantity, item))
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+    return lines, quantities
+
+
+def load_products_for_sale(user_id, product_ids):
+    """يجلب كل منتجات السلة باستعلام واحد مع قفل الصفوف (FOR UPDATE حيث يدعمه المحرك)."""
+    products = Product.query.filter(
+        Product.id.in_(product_ids),
+        Product.user_id == user_id
+    ).with_for_update().all()
+    return {p.id: p for p in products}
+
+
+def decrement_stock(quantities):
+    """يخصم المخزون لكل المنتجات بعبارة UPDATE واحدة لا تسمح بالنزول تحت الصفر."""
+    qty = db.case(quantities, value=Product.id)
+    result = db.session.execute(
+        update(Product)
+        .where(Product.id.in_(list(quantities)), Product.quantity_in_stock >= qty)
+        .values(quantity_in_stock=Product.quantity_in_stock - qty)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != len(quantities):
+        # سبقنا طلب متزامن وخصم من نفس المنتج
+        raise SaleError("الكمية غير متوفرة لأحد المنتجات، يرجى تحديث السلة.", 409)
+
+
+def price_sale_lines(lines, products):
+    """يحسب أسعار الأسطر والإجمالي في الخادم من بيانات المنتج فقط (السعر المرسل من العميل يُتجاهل)."""
+    priced = []
+    total = Decimal('0')
+    for product_id, quantity, item in lines:
+        product = products.get(product_id)
+        if product is None:
+            raise SaleError(f"المنتج {item.get('name', product_id)} غير موجود.", 404)
+        price = product.retail_price
+        if price is None:
+            raise SaleError(f"لا يوجد سعر بيع للمنتج {product.name}، يرجى تحديد سعره أولاً.")
+        line_total = price * quantity
+        priced.append((product_id, quantity, price, line_total))
+        total += line_total
+    return priced, total
+
+
+def check_stock(quantities, products):
+    for product_id, quantity in quantities.items():
+        product = products[product_id]
+        if product.quantity_in_stock < quantity:
+            raise SaleError(f"الكمية غير متوفرة للمنتج {product.name}")
+
+
+def sale_rollup_deltas(priced_lines, products):
+    """فروق الملخص اليومي لعملية بيع واحدة."""
+    return {
+        "revenue": sum((line_total for _, _, _, line_total in priced_lines), Decimal('0')),
+        "cogs": sum((products[pid].cost_price * qty for pid, qty, _, _ in priced_lines), Decimal('0')),
+        "items_sold": sum(qty for _, qty, _, _ in priced_lines),
+        "sales_count": 1
+    }
+
+
+def build_sale_item_rows(sale_id, priced_lines, products, user_id, sold_at):
+    return [{
+        "sale_id": sale_id,
+        "product_id": product_id,
+        "quantity": quantity,
+        "price_per_unit": price,
+        "total_item_price": line_total,
+        "user_id": user_id,
+        "unit_cost": products[product_id].cost_price,
+        "sold_at": sold_at
+    } for product_id, quantity, price, line_total in priced_lines]
+
+
 # API: إتمام عملية بيع
 @app.route('/api/sales', methods=['POST'])
+@idempotent('sales')
 def process_sale():
+    if 'logged_in' not in session or 'user_id' not in session:
+        return jsonify({"error": "غير مصرح لك بالوصول"}), 401
+
+    user_id = session['user_id']
+
     try:
         sale_data = request.get_json()
-        cart_items = sale_data['cart']
-        total_amount = sale_data['total_amount']
         payment_method = sale_data['payment_method']
         amount_paid = sale_data.get('amount_paid')
+        lines, quantities = aggregate_cart(sale_data['cart'])
+
+        # 1. استعلام واحد لكل منتجات السلة (مقفلة حتى نهاية المعاملة)
+        products = load_products_for_sale(user_id, list(quantities))
+        priced_lines, total_amount = price_sale_lines(lines, products)
+        check_stock(quantities, products)
+
+        # 2. الإجمالي والباقي يُحسبان في الخادم
         change_amount = sale_data.get('change_amount')
+        if amount_paid is not None:
+            amount_paid = Decimal(str(amount_paid))
+            change_amount = amount_paid - total_amount
 
-        # إنشاء سجل بيع جديد
+        sold_at = datetime.utcnow()
         new_sale = Sale(
+            sale_date=sold_at,
             total_amount=total_amount,
             payment_method=payment_method,
             amount_paid=amount_paid,
-            change_amount=change_amount
-            # يمكن إضافة employee_id لاحقاً
+            change_amount=change_amount,
+            employee_id=user_id
         )
         db.session.add(new_sale)
         db.session.flush()  # للحصول على sale_id قبل commit
 
-        # معالجة عناصر سلة المشتريات
-        for item in cart_items:
-            product = Product.query.get(item['id'])
-            if not product or product.quantity_in_stock < item['quantity']:
-                db.session.rollback()
-                return jsonify({"error": f"الكمية غير متوفرة للمنتج {item['name']}"}), 400
-
-            # تحديث المخزون
-            product.quantity_in_stock -= item['quantity']
-
-            # إضافة عنصر البيع
-            sale_item = SaleItem(
-                sale_id=new_sale.sale_id,
-                product_id=product.id,
-                quantity=item['quantity'],
-                price_per_unit=item['retail_price'],
-                total_item_price=item['retail_price'] * item['quantity']
-            )
-            db.session.add(sale_item)
+        # 3. خصم المخزون بعبارة واحدة مشروطة، ثم إدراج كل الأسطر دفعة واحدة
+        decrement_stock(quantities)
+        db.session.execute(insert(SaleItem), build_sale_item_rows(new_sale.sale_id, priced_lines, products, user_id, sold_at))
+        add_to_daily_rollup(user_id, sold_at.date(), **sale_rollup_deltas(priced_lines, products))
 
+        sold_products = list(products.values())
+        record_product_changes(user_id, [p.id for p in sold_products])
         db.session.commit()
-        return jsonify({"message": "تم إتمام عملية البيع بنجاح.", "sale_id": new_sale.sale_id}), 201
+        discard_cached_products(sold_products)
+        return jsonify({
+            "message": "تم إتمام عملية البيع بنجاح.",
+            "sale_id": new_sale.sale_id,
+            "total_amount": float(total_amount)
+        }), 201
 
-    except KeyError:
+    except SaleError as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), e.status
+    except (KeyError, TypeError, InvalidOperation):
         db.session.rollback()
         return jsonify({"error": "البيانات غير مكتملة"}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
+SALES_BATCH_MAX_SIZE = 500
+
+
+def parse_offline_sale_date(value):
+    """تاريخ البيع كما سجلته نقطة البيع أثناء انقطاع الاتصال (ISO 8601)."""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        raise SaleError("تنسيق تاريخ البيع غير صالح.")
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+# API: رفع مجموعة مبيعات دفعة واحدة (نقاط البيع بعد عودة الاتصال)
+@app.route('/api/sales/batch', methods=['POST'])
+@idempotent('sales_batch')
+def process_sales_batch():
+    if 'logged_in' not in session or 'user_id' not in session:
+        return jsonify({"error": "غير مصرح لك بالوصول"}), 401
+
+    user_id = session['user_id']
+    data = request.get_json(silent=True) or {}
+    sales = data.get('sales') if isinstance(data, dict) else None
+    if not isinstance(sales, list) or not sales:
+        return jsonify({"error": "قائمة المبيعات فارغة أو غير صالحة."}), 400
+    if len(sales) > SALES_BATCH_MAX_SIZE:
+        return jsonify({"error": f"الحد الأقصى {SALES_BATCH_MAX_SIZE} عملية بيع في الطلب الواحد."}), 400
+
+    results = [None] * len(sales)
+    parsed = []
+
+    # 1. التحقق من كل عملية بيع على حدة (خطأ في عملية لا يوقف الباقي)
+    for index, sale_data in enumerate(sales):
+        client_ref = sale_data.get('client_ref') if isinstance(sale_data, dict) else None
+        try:
+            if not isinstance(sale_data, dict) or 'payment_method' not in sale_data:
+                raise SaleError("البيانات غير مكتملة")
+            lines, quantities = aggregate_cart(sale_data.get('cart'))
+            sale_date = parse_offline_sale_date(sale_data.get('sale_date')) or datetime.utcnow()
+            parsed.append((index, client_ref, sale_data, lines, quantities, sale_date))
+        except SaleError as e:
+            results[index] = {"client_ref": client_ref, "status": "rejected", "error": str(e)}
+
+    try:
+        # 2. استعلام واحد لكل المنتجات في كل المبيعات
+        product_ids = {pid for *_, quantities, _ in parsed for pid in quantities}
+        products = load_products_for_sale(user_id, list(product_ids)) if product_ids else {}
+        available = {pid: p.quantity_in_stock for pid, p in products.items()}
+
+        # 3. تسعير وتوزيع المخزون بالترتيب المُرسل، مع تجميع الخصم لكل منتج
+        accepted = []
+        total_quantities = {}
+        for index, client_ref, sale_data, lines, quantities, sale_date in parsed:
+            try:
+                priced_lines, total_amount = price_sale_lines(lines, products)
+                short = [pid for pid, qty in quantities.items() if available[pid] < qty]
+                if short:
+                    raise SaleError(f"الكمية غير متوفرة للمنتج {products[short[0]].name}")
+            except SaleError as e:
+                results[index] = {"client_ref": client_ref, "status": "rejected", "error": str(e)}
+                continue
+            for pid, qty in quantities.items():
+                available[pid] -= qty
+                total_quantities[pid] = total_quantities.get(pid, 0) + qty
+            accepted.append((index, client_ref, sale_data, priced_lines, total_amount, sale_date))
+
+        if accepted:
+            # 4. كل صف منتج يُحدّث مرة واحدة فقط للدفعة كلها
+            decrement_stock(total_quantities)
+
+            # 5. إدراج المبيعات دفعة واحدة مع استرجاع المعرّفات بنفس الترتيب
+            sale_rows = []
+            for index, client_ref, sale_data, priced_lines, total_amount, sale_date in accepted:
+                amount_paid = sale_data.get('amount_paid')
+                change_amount = sale_data.get('change_amount')
+                if amount_paid is not None:
+                    amount_paid = Decimal(str(amount_paid))
+                    change_amount = amount_paid - total_amount
+                sale_rows.append({
+                    "sale_date": sale_date,
+                    "total_amount": total_amount,
+                    "payment_method": sale_data['payment_method'],
+                    "amount_paid": amount_paid,
+                    "change_amount": change_amount,
+                    "employee_id": user_id
+                })
+
+            sale_ids = db.session.execute(
+                insert(Sale).returning(Sale.sale_id, sort_by_parameter_order=True),
+                sale_rows
+            ).scalars().all()
+
+            item_rows = []
+            rollups = {}
+            for (index, client_ref, _, priced_lines, total_amount, sale_date), sale_id in zip(accepted, sale_ids):
+                item_rows.extend(build_sale_item_rows(sale_id, priced_lines, products, user_id, sale_date))
+                day = sale_date.date()
+                day_totals = rollups.setdefault(day, {})
+                for metric, value in sale_rollup_deltas(priced_lines, products).items():
+                    day_totals[metric] = day_totals.get(metric, 0) + value
+                results[index] = {
+                    "client_ref": client_ref,
+                    "status": "created",
+                    "sale_id": sale_id,
+                    "total_amount": float(total_amount)
+                }
+            db.session.execute(insert(SaleItem), item_rows)
+            # تحديث واحد للملخص لكل يوم في الدفعة
+            for day, day_totals in rollups.items():
+                add_to_daily_rollup(user_id, day, **day_totals)
+
+            record_product_changes(user_id, list(total_quantities))
+        db.session.commit()
+    except SaleError as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), e.status
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+    discard_cached_products([products[pid] for pid in total_quantities])
+    return jsonify({
+        "created": sum(1 for r in results if r["status"] == "created"),
+        "rejected": sum(1 for r in results if r["status"] == "rejected"),
+        "results": results
+    }), 200
+
 # API: جلب تفاصيل منتج معين
 @app.route('/api/products/<int:product_id>', methods=['GET'])
 def get_product(product_id):
@@ -1110,37 +3007,263 @@ from datetime import datetime, timedelta # تأكد من أن هذا الاست
 # دوال المساعدة الداخلية لحساب الأرباح والخسائر
 # =========================================================================
 
-def calculate_cogs_for_user(user_id, start_date, end_date):
-    """تحسب تكلفة البضاعة المباعة (COGS) بناءً على المستخدم والفترة."""
-    
-    # يجب أن نضمن أن سعر التكلفة المأخوذ من جدول Product هو للمنتجات المباعة 
-    # خلال الفترة المحددة، والتي يمتلكها المستخدم الحالي (user_id).
-    
-    cogs_result = db.session.query(
-        func.coalesce(func.sum(
-            SaleItem.quantity * Product.cost_price
-        ), 0)
-    ).join(Sale, SaleItem.sale_id == Sale.sale_id).join(Product, SaleItem.product_id == Product.id).filter(
-        Sale.sale_date.between(start_date, end_date),
-        Product.user_id == user_id 
-    ).scalar() 
-    
-    # التحويل إلى float لضمان التنسيق الصحيح للـ JSON
-    return float(cogs_result)
+def profit_loss_from_facts(user_id, start_date, end_date):
+    """يحسب الإيرادات والتكلفة والمصروفات من الجداول الأصلية بعبارة واحدة (CTE).
+
+    الإيراد هو مجموع أسطر البيع (total_item_price) وليس Sale.total_amount،
+    حتى لا تُحسب عملية البيع مرة لكل سطر فيها.
+    """
+    # نهاية الفترة شاملة لليوم الأخير كاملاً (sold_at من نوع DateTime)
+    end_exclusive = end_date + timedelta(days=1)
+
+    # جدول واحد: المستخدم والتكلفة والتاريخ محفوظة في سطر البيع نفسه
+    sales_totals = select(
+        func.coalesce(func.sum(SaleItem.total_item_price), 0).label('revenue'),
+        func.coalesce(func.sum(SaleItem.quantity * SaleItem.unit_cost), 0).label('cogs')
+    ).where(
+        SaleItem.user_id == user_id,
+        SaleItem.sold_at >= start_date,
+        SaleItem.sold_at < end_exclusive
+    ).cte('sales_totals')
+
+    expense_totals = select(
+        func.coalesce(func.sum(Expense.amount), 0).label('expenses')
+    ).where(
+        Expense.user_id == user_id,
+        Expense.expense_date.between(start_date, end_date)
+    ).cte('expense_totals')
+
+    return db.session.execute(
+        select(sales_totals.c.revenue, sales_totals.c.cogs, expense_totals.c.expenses)
+        .select_from(sales_totals.join(expense_totals, db.true()))
+    ).one()
+
+
+def profit_loss_from_rollups(user_id, start_date, end_date):
+    """نفس الأرقام من الملخصات اليومية (صف لكل يوم) باستعلام واحد."""
+    return db.session.query(
+        func.coalesce(func.sum(DailyRollup.revenue), 0),
+        func.coalesce(func.sum(DailyRollup.cogs), 0),
+        func.coalesce(func.sum(DailyRollup.expenses), 0)
+    ).filter(
+        DailyRollup.user_id == user_id,
+        DailyRollup.day.between(start_date, end_date)
+    ).one()
 
 # =========================================================================
-# مسار API: الأرباح والخسائر (/api/profit_loss)
+# الملخصات اليومية: إعادة البناء الكاملة من الجداول الأصلية
 # =========================================================================
 
-@app.route('/api/profit_loss', methods=['GET'])
-def get_profit_loss():
-    # 1. التحقق من تسجيل الدخول وتحديد المستخدم
+ROLLUP_INSERT_CHUNK = 1000
+
+
+def compute_rollups_from_facts(user_id=None):
+    """يحسب الملخصات اليومية من المبيعات والمرتجعات والمصروفات (استعلام مجمّع لكل مصدر)."""
+    rollups = {}
+
+    def add(owner_id, day, **values):
+        row = rollups.setdefault((owner_id, day), {k: 0 for k in ROLLUP_METRICS})
+        for metric, value in values.items():
+            row[metric] += value or 0
+
+    sale_day = func.date(SaleItem.sold_at, type_=db.Date)
+    sales_query = db.session.query(
+        SaleItem.user_id, sale_day,
+        func.sum(SaleItem.total_item_price),
+        func.sum(SaleItem.quantity * SaleItem.unit_cost),
+        func.sum(SaleItem.quantity),
+        func.count(func.distinct(SaleItem.sale_id))
+    ).filter(SaleItem.user_id.isnot(None))
+    if user_id is not None:
+        sales_query = sales_query.filter(SaleItem.user_id == user_id)
+    for owner_id, day, revenue, cogs, items, count in sales_query.group_by(SaleItem.user_id, sale_day):
+        add(owner_id, day, revenue=revenue, cogs=cogs, items_sold=items, sales_count=count)
+
+    returns_query = db.session.query(
+        Return.user_id, Return.return_date,
+        func.sum(Return.quantity),
+        func.sum(Return.quantity * func.coalesce(Return.retail_price, 0))
+    )
+    if user_id is not None:
+        returns_query = returns_query.filter(Return.user_id == user_id)
+    for owner_id, day, items, amount in returns_query.group_by(Return.user_id, Return.return_date):
+        add(owner_id, day, returned_items=items, returns_amount=amount)
+
+    expenses_query = db.session.query(
+        Expense.user_id, Expense.expense_date, func.sum(Expense.amount)
+    ).filter(Expense.user_id.isnot(None))
+    if user_id is not None:
+        expenses_query = expenses_query.filter(Expense.user_id == user_id)
+    for owner_id, day, amount in expenses_query.group_by(Expense.user_id, Expense.expense_date):
+        add(owner_id, day, expenses=amount)
+
+    return rollups
+
+
+SALE_ITEM_BACKFILL_BATCH = 10000
+
+
+@app.cli.command("backfill_sale_item_costs")
+@click.option("--batch-size", type=int, default=SALE_ITEM_BACKFILL_BATCH)
+def backfill_sale_item_costs(batch_size):
+    """يملأ user_id و unit_cost و sold_at لأسطر البيع القديمة على دفعات حسب item_id،
+    ثم Sale.employee_id للمبيعات القديمة من أسطرها (سجل المعاملات يقرأ المبيعات به).
+
+    يأتي بعد upgrade_db وقبل rebuild_rollups (الملخصات تُبنى من هذه الأعمدة).
+    """
+    upgrade_schema()
+    max_id = db.session.query(func.max(SaleItem.item_id)).scalar() or 0
+    updated = 0
+    for start in range(0, max_id, batch_size):
+        result = db.session.execute(
+            update(SaleItem)
+            .where(
+                SaleItem.item_id > start,
+                SaleItem.item_id <= start + batch_size,
+                SaleItem.user_id.is_(None)
+            )
+            .values(
+                user_id=select(Product.user_id).where(Product.id == SaleItem.product_id).scalar_subquery(),
+                unit_cost=select(Product.cost_price).where(Product.id == SaleItem.product_id).scalar_subquery(),
+                sold_at=select(Sale.sale_date).where(Sale.sale_id == SaleItem.sale_id).scalar_subquery()
+            )
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        updated += result.rowcount
+    print(f"تم تحديث {updated} سطر بيع.")
+
+    # المبيعات القديمة أُنشئت دون employee_id: نأخذه من مالك أسطرها
+    item_owner = select(SaleItem.user_id).where(
+        SaleItem.sale_id == Sale.sale_id, SaleItem.user_id.isnot(None)
+    ).limit(1).scalar_subquery()
+    max_sale_id = db.session.query(func.max(Sale.sale_id)).scalar() or 0
+    updated = 0
+    for start in range(0, max_sale_id, batch_size):
+        result = db.session.execute(
+            update(Sale)
+            .where(
+                Sale.sale_id > start,
+                Sale.sale_id <= start + batch_size,
+                Sale.employee_id.is_(None),
+                item_owner.isnot(None)
+            )
+            .values(employee_id=item_owner)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        updated += result.rowcount
+    print(f"تم تحديث {updated} عملية بيع.")
+
+
+@app.cli.command("rebuild_rollups")
+@click.option("--user-id", type=int, default=None, help="إعادة بناء ملخصات مستخدم واحد فقط.")
+def rebuild_rollups(user_id):
+    """يعيد بناء جدول الملخصات اليومية من البيانات الأصلية."""
+    rollups = compute_rollups_from_facts(user_id)
+
+    delete_query = DailyRollup.query
+    if user_id is not None:
+        delete_query = delete_query.filter(DailyRollup.user_id == user_id)
+
+    affected_users = {row[0] for row in delete_query.with_entities(DailyRollup.user_id).distinct()}
+    delete_query.delete(synchronize_session=False)
+
+    rows = [dict(values, user_id=owner_id, day=day) for (owner_id, day), values in rollups.items()]
+    for start in range(0, len(rows), ROLLUP_INSERT_CHUNK):
+        db.session.execute(insert(DailyRollup), rows[start:start + ROLLUP_INSERT_CHUNK])
+    for owner_id in affected_users | {owner_id for owner_id, _ in rollups}:
+        bump_resource_version('reports', owner_id)
+    db.session.commit()
+    print(f"تم بناء {len(rows)} ملخص يومي.")
+
+# =========================================================================
+# ذاكرة مؤقتة لنتائج التقارير (لكل مستخدم/تقرير/فترة)
+# =========================================================================
+
+REPORT_CACHE_TTL = int(os.getenv('REPORT_CACHE_TTL', 300))
+REPORT_CACHE_BACKEND = os.getenv('REPORT_CACHE_BACKEND', 'memory')  # memory | filesystem
+REPORT_CACHE_DIR = os.getenv('REPORT_CACHE_DIR', os.path.join(app.instance_path, 'report_cache'))
+
+
+def create_report_cache_backend(kind):
+    if kind == 'filesystem':
+        # مشتركة بين عمال gunicorn على نفس الجهاز
+        from cachelib import FileSystemCache
+        return FileSystemCache(REPORT_CACHE_DIR, threshold=5000, default_timeout=REPORT_CACHE_TTL)
+    return LRUTTLCache(default_timeout=REPORT_CACHE_TTL)
+
+
+class ReportCache:
+    """
+    مفتاح الإدخال يتضمن أرقام إصدار الموارد التي يعتمد عليها التقرير (ResourceVersion)،
+    فأي كتابة تزيد الإصدار تجعل الإدخالات القديمة غير قابلة للوصول في كل العمال دون حذف صريح.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _count(self, report, outcome):
+        with self._lock:
+            counters = self._stats.setdefault(report, {"hits": 0, "misses": 0})
+            counters[outcome] += 1
+
+    def make_key(self, report, user_id, dependencies, params):
+        scopes = db.or_(*[
+            db.and_(ResourceVersion.resource == resource, ResourceVersion.scope_id == scope_id)
+            for resource, scope_id in dependencies
+        ])
+        versions = dict(
+            ((resource, scope_id), version) for resource, scope_id, version in
+            db.session.query(ResourceVersion.resource, ResourceVersion.scope_id, ResourceVersion.version).filter(scopes)
+        )
+        generation = '.'.join(str(versions.get(dep, 0)) for dep in dependencies)
+        params_digest = hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:16]
+        return f"report:{report}:{user_id}:{generation}:{params_digest}"
+
+    def get_or_compute(self, report, user_id, dependencies, params, compute):
+        key = self.make_key(report, user_id, dependencies, params)
+        payload = self.backend.get(key)
+        if payload is not None:
+            self._count(report, "hits")
+            return payload
+        self._count(report, "misses")
+        payload = compute()
+        self.backend.set(key, payload)
+        return payload
+
+    def stats(self):
+        with self._lock:
+            reports = {name: dict(counters) for name, counters in self._stats.items()}
+        hits = sum(c["hits"] for c in reports.values())
+        misses = sum(c["misses"] for c in reports.values())
+        return {
+            "backend": REPORT_CACHE_BACKEND,
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": round(hits / (hits + misses), 4) if hits + misses else None,
+            "reports": reports
+        }
+
+
+report_cache = ReportCache(create_report_cache_backend(REPORT_CACHE_BACKEND))
+
+
+# API: إحصائيات ذاكرة التقارير المؤقتة (لهذه العملية فقط)
+@app.route('/api/reports/cache-stats', methods=['GET'])
+def get_report_cache_stats():
     if 'logged_in' not in session or 'user_id' not in session:
         return jsonify({"error": "غير مصرح لك بالوصول"}), 401
-    
-    user_id = session['user_id']
-    
-    # 2. تحديد الفترة الزمنية
+    return jsonify(report_cache.stats()), 200
+
+# =========================================================================
+# مسار API: الأرباح والخسائر (/api/profit_loss)
+# =========================================================================
+
+def resolve_report_period():
+    """يحدد فترة التقرير من معاملات الطلب (period/start_date/end_date): (البداية، النهاية، الوصف، الخطأ)."""
     period_type = request.args.get('period', 'month')
     start_date = None
     end_date = None
@@ -1170,76 +3293,463 @@ def get_profit_loss():
             period_label = f"من {start_date_str} إلى {end_date_str}"
         
         if not start_date or not end_date:
-            return jsonify({"error": "فترة زمنية غير محددة"}), 400
+            return None, None, None, "فترة زمنية غير محددة"
 
     except Exception as e:
         # إذا فشل التحويل التاريخي، يجب أن يعود بخطأ 400
-        return jsonify({"error": f"خطأ في معالجة التاريخ أو تنسيقه: {str(e)}"}), 400
+        return None, None, None, f"خطأ في معالجة التاريخ أو تنسيقه: {str(e)}"
 
+    return start_date, end_date, period_label, None
 
-    # 3. جلب البيانات المالية مع الفلترة حسب المستخدم (user_id)
-    
-    # (أ) إجمالي الإيرادات (المبيعات الفعلية)
-    total_revenue = db.session.query(
-        func.coalesce(func.sum(Sale.total_amount), 0)
-    ).join(SaleItem, SaleItem.sale_id == Sale.sale_id).join(Product, SaleItem.product_id == Product.id).filter(
-        Sale.sale_date.between(start_date, end_date),
-        Product.user_id == user_id 
-    ).scalar()
-    
-    # (ب) تكلفة البضاعة المباعة (COGS) - باستخدام الدالة المساعدة
-    total_cogs = calculate_cogs_for_user(user_id, start_date, end_date) 
-    
-    # (ج) إجمالي المصروفات 
-    total_expenses = db.session.query(
-        func.coalesce(func.sum(Expense.amount), 0)
-    ).filter(
-        Expense.expense_date.between(start_date, end_date),
-        Expense.user_id == user_id 
-    ).scalar()
-    
-    
-    # تحويل النتائج إلى أرقام عشرية
-    total_revenue = float(total_revenue)
-    total_cogs = float(total_cogs)
-    total_expenses = float(total_expenses) 
+
+@app.route('/api/profit_loss', methods=['GET'])
+def get_profit_loss():
+    # 1. التحقق من تسجيل الدخول وتحديد المستخدم
+    if 'logged_in' not in session or 'user_id' not in session:
+        return jsonify({"error": "غير مصرح لك بالوصول"}), 401
     
-    # 4. حساب صافي الربح
-    net_profit_loss = total_revenue - total_cogs - total_expenses
+    user_id = session['user_id']
     
+    # 2. تحديد الفترة الزمنية
+    start_date, end_date, period_label, error = resolve_report_period()
+    if error:
+        return jsonify({"error": error}), 400
+
+    # 3. جلب البيانات المالية باستعلام واحد: من الملخصات اليومية افتراضياً،
+    # أو من الجداول الأصلية مباشرة (?source=facts) للمطابقة والتدقيق
+    source = 'facts' if request.args.get('source') == 'facts' else 'rollups'
+
+    def compute():
+        if source == 'facts':
+            total_revenue, total_cogs, total_expenses = profit_loss_from_facts(user_id, start_date, end_date)
+        else:
+            total_revenue, total_cogs, total_expenses = profit_loss_from_rollups(user_id, start_date, end_date)
+
+        # تحويل النتائج إلى أرقام عشرية
+        total_revenue = float(total_revenue)
+        total_cogs = float(total_cogs)
+        total_expenses = float(total_expenses)
+
+        # 4. حساب صافي الربح
+        net_profit_loss = total_revenue - total_cogs - total_expenses
+
+        return {
+            "period_label": period_label,
+            "total_revenue": round(total_revenue, 2),
+            "total_cogs": round(total_cogs, 2),
+            "total_expenses": round(total_expenses, 2),
+            "net_profit_loss": round(net_profit_loss, 2)
+        }
+
+    # مسار التدقيق (facts) يتجاوز الذاكرة المؤقتة دائماً
+    if source == 'facts':
+        return jsonify(compute())
+
     # 5. إرجاع النتيجة
-    return jsonify({
-        "period_label": period_label,
-        "total_revenue": round(total_revenue, 2),
-        "total_cogs": round(total_cogs, 2),
-        "total_expenses": round(total_expenses, 2),
-        "net_profit_loss": round(net_profit_loss, 2)
-    })
+    return jsonify(report_cache.get_or_compute(
+        'profit_loss', user_id, [('reports', user_id)],
+        {"start": start_date, "end": end_date, "label": period_label},
+        compute
+    ))
+
+
+# =========================================================================
+# مسار API: ملخص التقارير المالية (/api/reports/summary)
+# =========================================================================
+
+@app.route('/api/reports/summary', methods=['GET'])
+@tenant_required
+def get_reports_summary():
+    """أرقام الميزانية المختصرة (الربح والخسارة، قيمة المخزون، الرواتب) محسوبة في قاعدة البيانات."""
+    user_id = g.tenant.user_id
+    company_id = g.tenant.company_id
+
+    start_date, end_date, period_label, error = resolve_report_period()
+    if error:
+        return jsonify({"error": error}), 400
+
+    def compute():
+        total_revenue, total_cogs, total_expenses = profit_loss_from_rollups(user_id, start_date, end_date)
+
+        # قيمة المخزون بسعر الجملة (أو التكلفة إن لم يحدد) وإجمالي الرواتب في عبارة واحدة
+        inventory_value = select(
+            func.coalesce(func.sum(Product.quantity_in_stock * func.coalesce(Product.wholesale_price, Product.cost_price)), 0)
+        ).where(Product.user_id == user_id).scalar_subquery()
+        if company_id is None:
+            payroll = literal(0)
+        else:
+            payroll = select(
+                func.coalesce(func.sum(User.salary), 0)
+            ).where(
+                User.company_id == company_id,
+                User.role.in_(['employee', 'company_admin'])
+            ).scalar_subquery()
+        inventory_value, total_salaries = db.session.execute(select(inventory_value, payroll)).one()
+
+        total_revenue = float(total_revenue)
+        total_cogs = float(total_cogs)
+        total_expenses = float(total_expenses)
+        return {
+            "period_label": period_label,
+            "total_revenue": round(total_revenue, 2),
+            "total_cogs": round(total_cogs, 2),
+            "total_expenses": round(total_expenses, 2),
+            "net_profit_loss": round(total_revenue - total_cogs - total_expenses, 2),
+            "inventory_value": round(float(inventory_value), 2),
+            "total_salaries": round(float(total_salaries), 2)
+        }
+
+    return jsonify(report_cache.get_or_compute(
+        'summary', user_id,
+        [('reports', user_id), ('products', user_id), ('employees', company_id)],
+        {"start": start_date, "end": end_date, "label": period_label},
+        compute
+    )), 200
+
+# =========================================================================
+# التوقعات: حساب دفعي لكل المستخدمين (flask compute_forecasts) وقراءة جاهزة من الجدول
+# =========================================================================
+
+FORECAST_HISTORY_DAYS = 365
+FORECAST_MONTHS = 6
+FORECAST_SERIES = ('revenue', 'profit')
+
+
+def forecast_horizon(today):
+    """عدد الأيام من الغد حتى نهاية الشهر السادس القادم (أشهر كاملة فقط في العرض)."""
+    month_index = today.year * 12 + today.month - 1 + FORECAST_MONTHS + 1
+    last_day = datetime(month_index // 12, month_index % 12 + 1, 1).date() - timedelta(days=1)
+    return (last_day - today).days
+
+
+def monthly_forecast_totals(today, result):
+    """يجمع التوقع اليومي لكل السلاسل إلى أشهر (ضرب مصفوفات) مع هامش الثقة الشهري."""
+    horizon = result["forecast"].shape[1]
+    days = [today + timedelta(days=h) for h in range(1, horizon + 1)]
+    month_keys = sorted({(d.year, d.month) for d in days})[-FORECAST_MONTHS:]
+    # مصفوفة انتماء (الأشهر × الأيام)
+    membership = np.array([[(d.year, d.month) == key for d in days] for key in month_keys], dtype=float)
+    totals = result["forecast"] @ membership.T
+    # مجموع أيام مستقلة: الانحرافات تجمع تربيعياً
+    margins = forecasting.CONFIDENCE_Z * np.sqrt(np.square(result["spread"]) @ membership.T)
+    return days, month_keys, totals, margins
+
+
+def build_forecast_payload(days, month_keys, result, totals, margins, row):
+    """يبني استجابة المستخدم (شهرية ويومية مع حدود الثقة) من صفوف سلسلتيه."""
+    payload = {
+        "months": [datetime(y, m, 1).strftime("%B") for y, m in month_keys],
+        "daily": {"dates": [d.isoformat() for d in days]}
+    }
+    for offset, name in enumerate(FORECAST_SERIES):
+        index = row + offset
+        payload[name] = {
+            "monthly": np.round(totals[index], 2).tolist(),
+            "lower": np.round(totals[index] - margins[index], 2).tolist(),
+            "upper": np.round(totals[index] + margins[index], 2).tolist()
+        }
+        payload["daily"][name] = {
+            key: np.round(result[key][index], 2).tolist() for key in ('forecast', 'lower', 'upper')
+        }
+
+    # توافق مع الواجهة الحالية (forecasts.html)
+    payload["profits"] = payload["profit"]["monthly"]
+    return payload
+
+
+# =========================================================================
+# نقاط إعادة الطلب: سرعة البيع لكل منتج وأيام التغطية (حساب دفعي)
+# =========================================================================
+
+VELOCITY_WINDOW_DAYS = int(os.getenv('VELOCITY_WINDOW_DAYS', 28))
+REORDER_LEAD_TIME_DAYS = int(os.getenv('REORDER_LEAD_TIME_DAYS', 7))
+REORDER_SAFETY_DAYS = int(os.getenv('REORDER_SAFETY_DAYS', 3))
+REORDER_TARGET_COVER_DAYS = int(os.getenv('REORDER_TARGET_COVER_DAYS', 30))
+REORDER_INSERT_CHUNK = 5000
+
+
+@app.cli.command("compute_reorder_points")
+@click.option("--user-id", type=int, default=None, help="مستخدم واحد فقط (افتراضياً الكل)")
+def compute_reorder_points(user_id):
+    """يحسب سرعة البيع ونقطة إعادة الطلب لكل المنتجات ويحدّث تنبيهات المخزون المنخفض (يشغّله clock.py دورياً)."""
+    today = datetime.utcnow().date()
+    since = datetime.utcnow() - timedelta(days=VELOCITY_WINDOW_DAYS)
+
+    # 1. الكميات المباعة لكل منتج في الفترة باستعلام GROUP BY واحد
+    sold_query = db.session.query(SaleItem.product_id, func.sum(SaleItem.quantity)).filter(
+        SaleItem.sold_at >= since, SaleItem.product_id.isnot(None)
+    )
+    products_query = db.session.query(Product.id, Product.user_id, Product.quantity_in_stock)
+    if user_id is not None:
+        sold_query = sold_query.filter(SaleItem.user_id == user_id)
+        products_query = products_query.filter(Product.user_id == user_id)
+    sold = sold_query.group_by(SaleItem.product_id).all()
+    products = products_query.order_by(Product.id).all()
+    if not products:
+        print("لا توجد منتجات.")
+        return
+
+    # 2. الحساب على كل المنتجات دفعة واحدة كمصفوفات
+    product_ids = np.array([p[0] for p in products])
+    owner_ids = np.array([p[1] for p in products])
+    stock = np.array([p[2] for p in products], dtype=float)
+    sold_quantity = np.zeros(len(products))
+    if sold:
+        sold_ids = np.array([r[0] for r in sold])
+        positions = np.searchsorted(product_ids, sold_ids)
+        found = (positions < len(product_ids)) & (product_ids[np.minimum(positions, len(product_ids) - 1)] == sold_ids)
+        sold_quantity[positions[found]] = np.array([float(r[1]) for r in sold])[found]
+
+    velocity = sold_quantity / VELOCITY_WINDOW_DAYS
+    reorder_point = np.ceil(velocity * (REORDER_LEAD_TIME_DAYS + REORDER_SAFETY_DAYS))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        days_of_cover = np.where(velocity > 0, stock / velocity, np.nan)
+    # نكمل المخزون ليغطي فترة الهدف بعد وصول الطلب
+    order_quantity = np.maximum(np.ceil(velocity * (REORDER_TARGET_COVER_DAYS + REORDER_LEAD_TIME_DAYS)) - stock, 0)
+    # تنبيه عند الوصول لنقطة إعادة الطلب، أو نفاد منتج بلا مبيعات حديثة
+    alerting = np.flatnonzero(((velocity > 0) & (stock <= reorder_point)) | (stock <= 0))
+
+    rows = [{
+        "product_id": int(product_ids[i]),
+        "user_id": int(owner_ids[i]),
+        "alert_date": today,
+        "current_quantity": int(stock[i]),
+        "daily_velocity": round(float(velocity[i]), 4),
+        "days_of_cover": None if np.isnan(days_of_cover[i]) else round(float(days_of_cover[i]), 2),
+        "reorder_point": int(reorder_point[i]),
+        "suggested_order_quantity": int(order_quantity[i])
+    } for i in alerting]
+
+    # 3. استبدال التنبيهات في نفس المعاملة (المنتجات التي تعافت تختفي تنبيهاتها)
+    delete_query = LowStockAlert.query
+    if user_id is not None:
+        delete_query = delete_query.filter(
+            LowStockAlert.product_id.in_(select(Product.id).where(Product.user_id == user_id))
+        )
+    delete_query.delete(synchronize_session=False)
+    for start in range(0, len(rows), REORDER_INSERT_CHUNK):
+        db.session.execute(insert(LowStockAlert), rows[start:start + REORDER_INSERT_CHUNK])
+    db.session.commit()
+    print(f"تمت معالجة {len(products)} منتج، منها {len(rows)} بحاجة لإعادة الطلب.")
+
+
+# API: تنبيهات إعادة الطلب للمستخدم (الأقل تغطية أولاً)
+@app.route('/api/products/reorder-alerts', methods=['GET'])
+def get_reorder_alerts():
+    if 'logged_in' not in session or 'user_id' not in session:
+        return jsonify({"error": "غير مصرح لك بالوصول"}), 401
+
+    alerts = LowStockAlert.query.filter_by(user_id=session['user_id']).order_by(
+        LowStockAlert.days_of_cover.is_(None), LowStockAlert.days_of_cover
+    ).all()
+    return jsonify([a.to_dict() for a in alerts]), 200
+
+
+@app.cli.command("compute_forecasts")
+def compute_forecasts():
+    """يحسب توقعات الإيرادات والأرباح لكل المستخدمين دفعة واحدة من الملخصات اليومية (يشغّله clock.py دورياً)."""
+    today = datetime.utcnow().date()
+    history_start = today - timedelta(days=FORECAST_HISTORY_DAYS)
+
+    rows = db.session.query(
+        DailyRollup.user_id, DailyRollup.day, DailyRollup.revenue,
+        DailyRollup.revenue - DailyRollup.cogs - DailyRollup.expenses
+    ).filter(DailyRollup.day >= history_start, DailyRollup.day < today).all()
+    if not rows:
+        print("لا توجد بيانات مبيعات لحساب التوقعات.")
+        return
+
+    user_ids = sorted({r[0] for r in rows})
+    position = {user_id: i for i, user_id in enumerate(user_ids)}
+    # صفان لكل مستخدم: الإيرادات ثم صافي الربح
+    user_rows = np.array([position[r[0]] * len(FORECAST_SERIES) for r in rows])
+    day_index = np.array([(r[1] - history_start).days for r in rows])
+    series = forecasting.build_series_matrix(
+        np.concatenate([user_rows, user_rows + 1]),
+        np.concatenate([day_index, day_index]),
+        np.array([float(r[2]) for r in rows] + [float(r[3]) for r in rows]),
+        len(user_ids) * len(FORECAST_SERIES),
+        FORECAST_HISTORY_DAYS
+    )
+    result = forecasting.forecast_series(series, forecast_horizon(today))
+    # الإيرادات لا تكون سالبة (الصفوف الزوجية)
+    result["forecast"][0::2] = np.maximum(result["forecast"][0::2], 0)
+    days, month_keys, totals, margins = monthly_forecast_totals(today, result)
+
+    computed_at = datetime.utcnow()
+    records = []
+    for user_id in user_ids:
+        row = position[user_id] * len(FORECAST_SERIES)
+        params = {
+            name: {
+                "model": result["model"][row + offset],
+                "alpha_beta_gamma": [None if np.isnan(v) else float(v) for v in result["params"][row + offset]]
+            }
+            for offset, name in enumerate(FORECAST_SERIES)
+        }
+        payload = build_forecast_payload(days, month_keys, result, totals, margins, row)
+        payload.update(model=params, computed_at=computed_at.isoformat())
+        records.append({
+            "user_id": user_id,
+            "computed_at": computed_at,
+            "params": json.dumps(params),
+            "payload": json.dumps(payload, ensure_ascii=False)
+        })
+
+    SalesForecast.query.filter(SalesForecast.user_id.in_(user_ids)).delete(synchronize_session=False)
+    db.session.execute(insert(SalesForecast), records)
+    db.session.commit()
+    print(f"تم حساب التوقعات لـ {len(records)} مستخدم.")
 
-# داخل كود Flask (مثلاً في app.py)
-from datetime import datetime, timedelta
-import random
-from flask import jsonify
 
 @app.route('/api/forecasts', methods=['GET'])
 def get_forecasts():
-    today = datetime.today()
-    months = []
-    profits = []
+    if 'logged_in' not in session or 'user_id' not in session:
+        return jsonify({"error": "غير مصرح لك بالوصول"}), 401
 
-    # قيمة افتراضية كبداية (ممكن تربطها بمبيعاتك الفعلية لاحقاً من DB)
-    current_profit = 40000  
+    forecast = db.session.get(SalesForecast, session['user_id'])
+    if forecast is None:
+        # لم يُحسب توقع بعد (لا تاريخ مبيعات أو لم يعمل الأمر المجدول)
+        return jsonify({"months": [], "profits": [], "computed_at": None}), 200
 
-    for i in range(6):
-        next_month = today + timedelta(days=30 * i)
-        month_name = next_month.strftime("%B")  # اسم الشهر بالإنجليزية
-        # توقع بزيادة منطقية 5% - 15%
-        growth = random.uniform(1.05, 1.15)
-        current_profit = int(current_profit * growth)
-        months.append(month_name)
-        profits.append(current_profit)
+    response = make_response(forecast.payload)
+    response.mimetype = 'application/json'
+    return response
+
+# =========================================================================
+# مصادر سجل المعاملات (مبيعات، مرتجعات): كل مصدر استعلام مرتب زمنياً ويُدمج بـ heapq
+# =========================================================================
+
+TRANSACTION_STREAM_BATCH = 1000
+
+
+def as_naive_utc(value):
+    """يوحد التاريخ/الوقت إلى datetime بدون منطقة زمنية (UTC) للمقارنة بين المصادر."""
+    if not isinstance(value, datetime):
+        return datetime(value.year, value.month, value.day)
+    if value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def sales_transactions_query(user_id, start_date=None, end_date=None):
+    query = select(Sale.sale_id, Sale.sale_date, Sale.total_amount).where(Sale.employee_id == user_id)
+    if start_date:
+        query = query.where(Sale.sale_date >= start_date)
+    if end_date:
+        query = query.where(Sale.sale_date < end_date + timedelta(days=1))
+    return query
+
+
+def returns_transactions_query(user_id, start_date=None, end_date=None):
+    query = select(
+        Return.return_id, Return.return_date, Return.quantity, Return.retail_price, Product.name
+    ).outerjoin(Product, Return.product_id == Product.id).where(Return.user_id == user_id)
+    if start_date:
+        query = query.where(Return.return_date >= start_date)
+    if end_date:
+        query = query.where(Return.return_date <= end_date)
+    return query
+
+
+def sale_transaction(row):
+    sale_id, sale_date, total_amount = row
+    amount = float(total_amount or 0)
+    return {
+        "id": sale_id,
+        "date": sale_date.strftime("%Y-%m-%d") if sale_date else "—",
+        "timestamp": as_naive_utc(sale_date) if sale_date else datetime.min,
+        "details": f"عملية بيع بمبلغ {amount:,.2f} ج.م",
+        "amount": amount,
+        "type": "sale"
+    }
+
+
+def return_transaction(row):
+    return_id, return_date, quantity, retail_price, product_name = row
+    return {
+        "id": return_id,
+        "date": return_date.strftime("%Y-%m-%d"),
+        "timestamp": as_naive_utc(return_date),
+        "details": f"مرتجع: {product_name or 'منتج محذوف'} × {quantity}",
+        "amount": float(retail_price or 0) * quantity,
+        "type": "return"
+    }
+
+
+# النوع -> (بناء الاستعلام، عمود التاريخ، عمود المعرّف، تحويل الصف، قراءة التاريخ من المؤشر)
+# أول عمودين في كل استعلام هما (المعرّف، التاريخ)
+TRANSACTION_SOURCES = {
+    "sale": (sales_transactions_query, Sale.sale_date, Sale.sale_id, sale_transaction,
+             datetime.fromisoformat),
+    "return": (returns_transactions_query, Return.return_date, Return.return_id, return_transaction,
+               lambda value: datetime.fromisoformat(value).date()),
+}
+
+
+def stream_transactions(user_id, start_date=None, end_date=None):
+    """كل معاملات المستخدم مرتبة زمنياً: دمج k مصادر مرتبة عبر مؤشرات من جهة الخادم (ذاكرة ثابتة)."""
+    def source_stream(kind):
+        build_query, date_column, id_column, to_transaction, _ = TRANSACTION_SOURCES[kind]
+        query = build_query(user_id, start_date, end_date).order_by(date_column.asc().nulls_first(), id_column)
+        result = db.session.execute(query.execution_options(yield_per=TRANSACTION_STREAM_BATCH))
+        for row in result:
+            yield to_transaction(row)
+
+    return heapq.merge(
+        *(source_stream(kind) for kind in TRANSACTION_SOURCES),
+        key=lambda t: (t["timestamp"], t["type"], t["id"])
+    )
+
+
+TRANSACTIONS_MAX_PAGE_SIZE = 200
+
+
+def encode_transactions_cursor(positions):
+    return base64.urlsafe_b64encode(json.dumps(positions).encode()).decode()
+
+
+def decode_transactions_cursor(cursor):
+    """المؤشر المركب: لكل مصدر (تاريخ، معرّف) آخر صف أُرسل منه."""
+    positions = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return {
+        kind: (TRANSACTION_SOURCES[kind][4](value[0]), int(value[1]))
+        for kind, value in positions.items() if kind in TRANSACTION_SOURCES
+    }, positions
+
+
+def transactions_page(user_id, limit, positions, start_date=None, end_date=None):
+    """صفحة من سجل المعاملات (الأحدث أولاً).
+
+    كل مصدر يُستعلم بترتيب تنازلي بعد موضعه في المؤشر مع limit + 1 صف فقط،
+    ثم تُدمج التدفقات المرتبة بـ heapq؛ التكلفة O(limit × عدد المصادر) مهما طال السجل.
+    """
+    streams = []
+    for kind, (build_query, date_column, id_column, to_transaction, _) in TRANSACTION_SOURCES.items():
+        query = build_query(user_id, start_date, end_date).where(date_column.isnot(None))
+        if kind in positions:
+            last_date, last_id = positions[kind]
+            query = query.where(db.or_(
+                date_column < last_date,
+                db.and_(date_column == last_date, id_column < last_id)
+            ))
+        rows = db.session.execute(
+            query.order_by(date_column.desc(), id_column.desc()).limit(limit + 1)
+        ).all()
+        # نحتفظ بالصف الخام لتحديث موضع المصدر في المؤشر
+        streams.append([(to_transaction(row), kind, row) for row in rows])
+
+    merged = heapq.merge(
+        *streams, key=lambda item: (item[0]["timestamp"], item[0]["type"], item[0]["id"]), reverse=True
+    )
+    page = []
+    for item in merged:
+        if len(page) == limit:
+            break
+        page.append(item)
+    has_more = sum(len(stream) for stream in streams) > len(page)
+    return page, has_more
 
-    return jsonify({"months": months, "profits": profits})
 
 # ------------------ API للمعاملات ------------------
 @app.route('/api/transactions', methods=['GET'])
@@ -1249,59 +3759,28 @@ def get_transactions():
 
     user_id = session['user_id']
 
-    # ✅ المرتجعات
-    returns = Return.query.filter_by(user_id=user_id).all()
-    returns_list = [dict(r.to_dict(), type="return") for r in returns]
-
-    # ✅ المبيعات
-    sales = Sale.query.all()  # ما عندك user_id داخل المبيعات، فنجيبها كلها مؤقتًا
-    sales_list = []
-    for s in sales:
-        sale_dict = {
-            "id": getattr(s, "sale_id", None),
-            "date": s.sale_date.strftime("%Y-%m-%d") if s.sale_date else "—",
-            "details": f"عملية بيع بمبلغ {float(s.total_amount):,.2f} ج.م",
-            "amount": float(s.total_amount) if s.total_amount else 0,
-            "type": "sale"
-        }
-        sales_list.append(sale_dict)
-
-    # ✅ الجرد (في حال كان موجود)
+    # سجل موحد (مبيعات + مرتجعات) مرقم بمؤشر مركب بدل تحميل كل شيء وترتيبه في الذاكرة
     try:
-        inventory_ops = InventoryReport.query.all()
-    except:
-        inventory_ops = []
-    inventory_list = []
-    for i in inventory_ops:
-        inventory_list.append({
-            "id": getattr(i, "report_id", None),
-            "date": i.end_date.strftime("%Y-%m-%d") if i.end_date else "—",
-            "details": f"تقرير جرد ({i.inventory_type or 'عام'})",
-            "amount": float(i.total_capital or 0),
-            "type": "inventory"
-        })
+        limit = min(max(int(request.args.get('limit', 50)), 1), TRANSACTIONS_MAX_PAGE_SIZE)
+        positions, raw_positions = decode_transactions_cursor(request.args['cursor']) if request.args.get('cursor') else ({}, {})
+        start_date = datetime.strptime(request.args['start_date'], '%Y-%m-%d').date() if request.args.get('start_date') else None
+        end_date = datetime.strptime(request.args['end_date'], '%Y-%m-%d').date() if request.args.get('end_date') else None
+    except (ValueError, TypeError, KeyError, AttributeError, IndexError):
+        return jsonify({"error": "قيمة limit أو cursor أو التاريخ غير صالحة."}), 400
+
+    page, has_more = transactions_page(user_id, limit, positions, start_date, end_date)
+
+    items = []
+    for transaction, kind, row in page:
+        raw_positions[kind] = [row[1].isoformat(), row[0]]
+        transaction = dict(transaction)
+        transaction.pop("timestamp")
+        items.append(transaction)
 
-    # ✅ الديون (من العملاء)
-    customers = Customer.query.filter_by(user_id=user_id).all()
-    debts_list = []
-    for c in customers:
-        # نضيف فقط العملاء اللي عندهم دين غير صفري
-        if hasattr(c, "debt") and c.debt and float(c.debt) > 0:
-            debts_list.append({
-                "id": getattr(c, "id", None),
-                "date": getattr(c, "updated_at", None).strftime("%Y-%m-%d") if hasattr(c, "updated_at") and c.updated_at else "—",
-                "details": f"دين على العميل: {c.name}",
-                "amount": float(c.debt),
-                "type": "debt"
-            })
-
-    # ✅ دمج الكل
-    transactions = returns_list + sales_list + inventory_list + debts_list
-
-    # ✅ ترتيب حسب التاريخ (تنازلي)
-    transactions.sort(key=lambda x: x.get("date", ""), reverse=True)
-
-    return jsonify(transactions), 200
+    return jsonify({
+        "items": items,
+        "next_cursor": encode_transactions_cursor(raw_positions) if has_more else None
+    }), 200
 # =========================
 
 # جلب جميع المرتجعات (GET /api/returns)
@@ -1313,16 +3792,68 @@ def get_returns():
 
     # 🧩 جلب المرتجعات الخاصة بالمستخدم الحالي فقط
     user_id = session.get('user_id')
-    returns = Return.query.filter_by(user_id=user_id).all()
+    return conditional_list_response('returns', user_id, lambda: build_returns_list(user_id, request.args))
+
 
-    data = [r.to_dict() for r in returns]
-    return jsonify(data), 200
+RETURNS_DEFAULT_PAGE_SIZE = 100
+RETURNS_MAX_PAGE_SIZE = 500
+
+
+def encode_returns_cursor(return_date, return_id):
+    return base64.urlsafe_b64encode(json.dumps([return_date.isoformat(), return_id]).encode()).decode()
+
+
+def decode_returns_cursor(cursor):
+    return_date, return_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return datetime.strptime(return_date, '%Y-%m-%d').date(), int(return_id)
+
+
+def build_returns_list(user_id, args):
+    # اسم المنتج يُجلب في نفس الاستعلام (JOIN) بدل SELECT منفصل لكل مرتجع في to_dict
+    query = Return.query.options(
+        joinedload(Return.product).load_only(Product.name)
+    ).filter(Return.user_id == user_id)
+
+    try:
+        if args.get('start_date'):
+            query = query.filter(Return.return_date >= datetime.strptime(args['start_date'], '%Y-%m-%d').date())
+        if args.get('end_date'):
+            query = query.filter(Return.return_date <= datetime.strptime(args['end_date'], '%Y-%m-%d').date())
+    except ValueError:
+        return jsonify({"error": "تنسيق التاريخ يجب أن يكون YYYY-MM-DD."}), 400
+
+    # بدون limit/cursor نُبقي الاستجابة القديمة (قائمة كاملة) للتوافق مع الواجهات
+    if 'limit' not in args and 'cursor' not in args:
+        return jsonify([r.to_dict() for r in query.order_by(Return.return_id).all()])
+
+    # الترقيم بالمؤشر (keyset) على (return_date, return_id) الأحدث أولاً، عبر الفهرس ix_returns_user_date
+    try:
+        limit = min(max(int(args.get('limit', RETURNS_DEFAULT_PAGE_SIZE)), 1), RETURNS_MAX_PAGE_SIZE)
+        cursor = decode_returns_cursor(args['cursor']) if args.get('cursor') else None
+    except (ValueError, TypeError):
+        return jsonify({"error": "قيمة limit أو cursor غير صالحة."}), 400
+
+    if cursor:
+        last_date, last_id = cursor
+        query = query.filter(db.or_(
+            Return.return_date < last_date,
+            db.and_(Return.return_date == last_date, Return.return_id < last_id)
+        ))
+    rows = query.order_by(Return.return_date.desc(), Return.return_id.desc()).limit(limit + 1).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return jsonify({
+        "items": [r.to_dict() for r in rows],
+        "next_cursor": encode_returns_cursor(rows[-1].return_date, rows[-1].return_id) if has_more else None
+    })
 
 
 # =========================
 # إضافة مرتجع جديد (POST /api/returns)
 # =========================
 @app.route('/api/returns', methods=['POST'])
+@idempotent('returns')
 def add_return():
     """ يسجل مرتجعًا جديدًا ويحدث مخزون المنتج. """
     data = request.get_json()
@@ -1399,7 +3930,14 @@ def add_return():
     db.session.add(new_return)
 
     try:
+        add_to_daily_rollup(
+            current_user_id, new_return.return_date,
+            returned_items=quantity, returns_amount=Decimal(str(retail_price)) * quantity
+        )
+        record_product_changes(current_user_id, [product_id_for_return])
+        bump_resource_version('returns', current_user_id)
         db.session.commit()
+        discard_cached_products([product])
         print(f"✅ تم تسجيل مرتجع جديد بنجاح للمستخدم ID={current_user_id}")
         return jsonify({"message": "تم تسجيل المرتجع بنجاح", "id": new_return.return_id}), 201
     except Exception as e:
@@ -1422,6 +3960,7 @@ def update_return(return_id):
     
     # حفظ الكمية القديمة قبل التحديث لحساب فرق المخزون
     old_quantity = r.quantity 
+    old_amount = Decimal(str(r.retail_price or 0)) * old_quantity
     
     try:
         new_quantity = int(data['quantity'])
@@ -1448,7 +3987,15 @@ def update_return(return_id):
     if new_product:
         new_product.quantity_in_stock += new_quantity
         
+    add_to_daily_rollup(
+        r.user_id, r.return_date,
+        returned_items=new_quantity - old_quantity,
+        returns_amount=Decimal(str(r.retail_price or 0)) * new_quantity - old_amount
+    )
+    record_product_changes(r.user_id, [p.id for p in (old_product, new_product) if p])
+    bump_resource_version('returns', r.user_id)
     db.session.commit()
+    discard_cached_products([old_product, new_product])
     return jsonify({"message": "تم تحديث المرتجع بنجاح"}), 200
 
 
@@ -1469,7 +4016,14 @@ def delete_return(return_id):
         
     # 2. حذف سجل المرتجع
     db.session.delete(r)
+    add_to_daily_rollup(
+        r.user_id, r.return_date,
+        returned_items=-r.quantity, returns_amount=-Decimal(str(r.retail_price or 0)) * r.quantity
+    )
+    record_product_changes(r.user_id, [product.id] if product else [])
+    bump_resource_version('returns', r.user_id)
     db.session.commit()
+    discard_cached_products([product])
     
     return jsonify({"message": "تم حذف المرتجع بنجاح"}), 200
 
@@ -1477,6 +4031,8 @@ def delete_return(return_id):
 # تسجيل Blueprint للمقارنات
 from comparisons_api import comparisons_bp
 app.register_blueprint(comparisons_bp)
+from exports_api import exports_bp
+app.register_blueprint(exports_bp)
 
 # =========================================================================
 # مسارات API جديدة للوحة تحكم المشرف (Admin Panel)
@@ -1590,6 +4146,7 @@ def edit_user(user_id):
     if new_password:
         user.password_hash = generate_password_hash(new_password)
     
+    bump_resource_version('employees', user.company_id)
     db.session.commit()
     return jsonify({"message": "تم تحديث بيانات المستخدم بنجاح"}), 200
 
@@ -0,0 +1,150 @@
+"""قياس زمن استعلام الأرباح والخسائر (profit_loss_from_facts) على بيانات مولّدة.
+
+يولّد مستخدمين ومنتجات ومبيعات وأسطر بيع ومصروفات في قاعدة بيانات منفصلة، ثم يقيس
+الاستعلام الواحد (CTE) لمستخدم واحد على فترات شهر وربع وسنة.
+
+الاستخدام (من جذر المشروع):
+    python bench/bench_profit_loss.py --db sqlite:////tmp/pl_bench.db --sale-items 10000000
+    python bench/bench_profit_loss.py --db sqlite:////tmp/pl_bench.db --skip-generate
+
+لا تشغّله على قاعدة بيانات الإنتاج: التوليد يضيف ملايين الصفوف.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+GENERATE_CHUNK = 100000
+ITEMS_PER_SALE = 3
+HISTORY_DAYS = 730
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', required=True, help='رابط قاعدة البيانات (SQLAlchemy URL).')
+    parser.add_argument('--sale-items', type=int, default=10000000)
+    parser.add_argument('--tenants', type=int, default=50)
+    parser.add_argument('--products-per-tenant', type=int, default=2000)
+    parser.add_argument('--expenses-per-tenant', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--skip-generate', action='store_true', help='استخدام بيانات مولّدة سابقاً.')
+    return parser.parse_args()
+
+
+def generate(db, models, args, end_day):
+    """يولّد البيانات على دفعات؛ كل سطر بيع يحمل user_id و unit_cost و sold_at كما يكتبها process_sale."""
+    User, Product, Sale, SaleItem, Expense = models
+    rng = np.random.default_rng(args.seed)
+    start = datetime.combine(end_day - timedelta(days=HISTORY_DAYS), datetime.min.time())
+
+    db.session.execute(db.insert(User), [
+        {"name": f"bench{t}", "email": f"bench{t}@example.com", "role": "company_admin"}
+        for t in range(args.tenants)
+    ])
+    user_ids = [row[0] for row in db.session.execute(db.select(User.id).order_by(User.id))][-args.tenants:]
+
+    n_products = args.tenants * args.products_per_tenant
+    cost = np.round(rng.uniform(1, 200, n_products), 2)
+    for offset in range(0, n_products, GENERATE_CHUNK):
+        db.session.execute(db.insert(Product), [
+            {"user_id": user_ids[i // args.products_per_tenant], "name": f"p{i}", "quantity_in_stock": 100,
+             "cost_price": float(cost[i]), "retail_price": float(cost[i] * 1.3), "wholesale_price": float(cost[i] * 1.15)}
+            for i in range(offset, min(offset + GENERATE_CHUNK, n_products))
+        ])
+    first_product = db.session.execute(db.select(db.func.min(Product.id)).where(Product.user_id == user_ids[0])).scalar()
+    db.session.commit()
+
+    n_sales = -(-args.sale_items // ITEMS_PER_SALE)
+    written = 0
+    for sale_offset in range(0, n_sales, GENERATE_CHUNK // ITEMS_PER_SALE):
+        count = min(GENERATE_CHUNK // ITEMS_PER_SALE, n_sales - sale_offset)
+        tenant = rng.integers(0, args.tenants, count)
+        seconds = rng.integers(0, HISTORY_DAYS * 86400, count)
+        sold_at = [start + timedelta(seconds=int(s)) for s in seconds]
+
+        lines = min(count * ITEMS_PER_SALE, args.sale_items - written)
+        sale_index = np.arange(lines) // ITEMS_PER_SALE
+        product = tenant[sale_index] * args.products_per_tenant + rng.integers(0, args.products_per_tenant, lines)
+        quantity = rng.integers(1, 6, lines)
+        price = np.round(cost[product] * 1.3, 2)
+        totals = np.zeros(count)
+        np.add.at(totals, sale_index, price * quantity)
+
+        sale_ids = db.session.execute(
+            db.insert(Sale).returning(Sale.sale_id, sort_by_parameter_order=True),
+            [{"employee_id": user_ids[tenant[i]], "sale_date": sold_at[i], "total_amount": float(round(totals[i], 2)),
+              "payment_method": "cash", "amount_paid": float(round(totals[i], 2)), "change_amount": 0}
+             for i in range(count)]
+        ).scalars().all()
+        db.session.execute(db.insert(SaleItem), [
+            {"sale_id": sale_ids[sale_index[j]], "product_id": first_product + int(product[j]),
+             "user_id": user_ids[tenant[sale_index[j]]], "quantity": int(quantity[j]),
+             "price_per_unit": float(price[j]), "total_item_price": float(round(price[j] * quantity[j], 2)),
+             "unit_cost": float(cost[product[j]]), "sold_at": sold_at[sale_index[j]]}
+            for j in range(lines)
+        ])
+        db.session.commit()
+        written += lines
+        print(f"\r  أسطر البيع: {written:,}", end='', flush=True)
+    print()
+
+    for user_id in user_ids:
+        days = rng.integers(0, HISTORY_DAYS, args.expenses_per_tenant)
+        db.session.execute(db.insert(Expense), [
+            {"user_id": user_id, "amount": float(a), "expense_date": end_day - timedelta(days=int(d)), "description": "bench"}
+            for a, d in zip(np.round(rng.uniform(10, 500, args.expenses_per_tenant), 2), days)
+        ])
+    db.session.commit()
+    return user_ids
+
+
+def measure(profit_loss_from_facts, user_id, start_day, end_day, repeat):
+    """الزمن (مللي ثانية) لكل تشغيل؛ الأول على ذاكرة تخزين باردة نسبياً ويُعرض منفصلاً."""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        profit_loss_from_facts(user_id, start_day, end_day)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def main():
+    args = parse_args()
+    os.environ['DATABASE_URL'] = args.db
+    from app import app, db, User, Product, Sale, SaleItem, Expense, profit_loss_from_facts
+
+    end_day = date(2026, 6, 30)
+    with app.app_context():
+        db.create_all()
+        if not args.skip_generate:
+            started = time.perf_counter()
+            generate(db, (User, Product, Sale, SaleItem, Expense), args, end_day)
+            print(f"التوليد: {time.perf_counter() - started:.0f} ث")
+
+        total_items = db.session.execute(db.select(db.func.count()).select_from(SaleItem)).scalar()
+        tenants = db.session.execute(
+            db.select(SaleItem.user_id, db.func.count()).group_by(SaleItem.user_id)
+            .order_by(db.func.count().desc()).limit(1)
+        ).first()
+        user_id, tenant_items = tenants
+        print(f"قاعدة البيانات: {db.engine.dialect.name} | أسطر البيع: {total_items:,} | "
+              f"المستخدم {user_id}: {tenant_items:,} سطر")
+
+        for label, days in (("شهر", 30), ("ربع", 91), ("سنة", 365)):
+            start_day = end_day - timedelta(days=days - 1)
+            timings = measure(profit_loss_from_facts, user_id, start_day, end_day, args.repeat)
+            warm = sorted(timings[1:]) or timings
+            revenue, cogs, expenses = profit_loss_from_facts(user_id, start_day, end_day)
+            print(f"{label:>4}: أول تشغيل {timings[0]:8.1f} ms | الوسيط {statistics.median(warm):8.1f} ms | "
+                  f"p95 {warm[int(len(warm) * 0.95) - 1]:8.1f} ms | الإيراد {float(revenue):,.2f}")
+
+
+if __name__ == '__main__':
+    main()
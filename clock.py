@@ -0,0 +1,41 @@
+import os
+import subprocess
+import sys
+import time
+
+# =========================================================================
+# المجدول (Procfile: clock): يشغّل أوامر الحساب الدفعي دورياً كعمليات مستقلة
+# حتى لا يبقى استهلاك الذاكرة لحساب كل المستخدمين داخل عملية الويب
+# =========================================================================
+
+REORDER_INTERVAL_MINUTES = int(os.getenv('REORDER_INTERVAL_MINUTES', 60))
+FORECAST_INTERVAL_MINUTES = int(os.getenv('FORECAST_INTERVAL_MINUTES', 24 * 60))
+
+# (أمر flask، الفاصل بالدقائق)
+JOBS = [
+    ("compute_reorder_points", REORDER_INTERVAL_MINUTES),
+    ("compute_forecasts", FORECAST_INTERVAL_MINUTES),
+]
+
+
+def run_job(command):
+    """يشغّل أمر flask ويسجل فشله دون إيقاف المجدول."""
+    started = time.monotonic()
+    result = subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', command])
+    status = "نجح" if result.returncode == 0 else f"فشل (رمز {result.returncode})"
+    print(f"[clock] {command}: {status} خلال {time.monotonic() - started:.1f} ث", flush=True)
+
+
+def main():
+    # كل الأوامر تعمل فور بدء التشغيل ثم حسب فاصلها
+    next_run = {command: time.monotonic() for command, _ in JOBS}
+    while True:
+        for command, interval in JOBS:
+            if time.monotonic() >= next_run[command]:
+                run_job(command)
+                next_run[command] = time.monotonic() + interval * 60
+        time.sleep(max(min(next_run.values()) - time.monotonic(), 1))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
-from flask import Blueprint, jsonify, session
+from flask import Blueprint, jsonify, session, request, g
 from datetime import datetime, timedelta
 from sqlalchemy import func
-from app import db, Sale, Expense, Customer, User
+from app import db, Sale, Expense, Customer, User, DailyRollup, report_cache, tenant_required
 
 comparisons_bp = Blueprint('comparisons_bp', __name__)
 
@@ -16,20 +16,16 @@ from sqlalchemy import func
 # API: بيانات صفحة المقارنات (Endpoint)
 # =========================================================================
 @comparisons_bp.route('/api/comparisons', methods=['GET'])
+@tenant_required
 def get_comparison_data():
-    # 1. التحقق من صلاحية الوصول
-    # ملاحظة: إذا كانت جلسات المستخدمين (sessions) غير مستخدمة، يجب تعديل هذا الجزء
-    if 'logged_in' not in session or 'user_id' not in session:
-        return jsonify({"error": "غير مصرح لك بالوصول. يرجى تسجيل الدخول."}), 401
+    # 1. سياق المستخدم (التحقق من الدخول في tenant_required)
+    user_id = g.tenant.user_id
 
-    user_id = session['user_id']
+    # ?granularity=...&periods=N: مقارنة عدد من الفترات بدلاً من الشهر الحالي/السابق
+    if 'granularity' in request.args or 'periods' in request.args:
+        return period_comparison_response(user_id)
     
-    # محاولة الحصول على بيانات الشركة/المستخدم للفلترة الصحيحة
-    current_user = User.query.get(user_id)
-    if not current_user:
-        return jsonify({"error": "بيانات المستخدم غير موجودة."}), 404
-        
-    company_id = current_user.company_id # افتراض أن الفلترة تكون على مستوى الشركة
+    company_id = g.tenant.company_id # افتراض أن الفلترة تكون على مستوى الشركة
 
     # 2. تحديد الفترات الزمنية
     today = datetime.now().date()
@@ -49,64 +45,210 @@ def get_comparison_data():
     current_month_name = start_current.strftime("%B")
     previous_month_name = start_previous.strftime("%B")
 
-    # 3. استعلامات قاعدة البيانات
+    def compute():
+        # 3. استعلامات قاعدة البيانات
     
-    # (أ) مبيعات الشهر الحالي والماضي (نفترض أن المبيعات مرتبطة بالشركة)
-    current_sales = db.session.query(func.coalesce(func.sum(Sale.total_amount), 0)).filter(
-        Sale.sale_date >= start_current,
-        Sale.sale_date <= end_current,
-        Sale.company_id == company_id # افتراض أن نموذج Sale يحتوي على company_id
-    ).scalar()
-
-    previous_sales = db.session.query(func.coalesce(func.sum(Sale.total_amount), 0)).filter(
-        Sale.sale_date >= start_previous,
-        Sale.sale_date <= end_previous,
-        Sale.company_id == company_id
-    ).scalar()
-
-    # (ب) المصروفات الشهرية (نفترض أنها مرتبطة بالشركة)
-    current_expenses = db.session.query(func.coalesce(func.sum(Expense.amount), 0)).filter(
-        Expense.expense_date >= start_current,
-        Expense.expense_date <= end_current,
-        Expense.company_id == company_id # افتراض أن نموذج Expense يحتوي على company_id
-    ).scalar()
-
-    previous_expenses = db.session.query(func.coalesce(func.sum(Expense.amount), 0)).filter(
-        Expense.expense_date >= start_previous,
-        Expense.expense_date <= end_previous,
-        Expense.company_id == company_id
-    ).scalar()
-
-    # (ج) الأرباح (صافي الربح)
-    current_profit = float(current_sales or 0) - float(current_expenses or 0)
-    previous_profit = float(previous_sales or 0) - float(previous_expenses or 0)
-
-    # (د) عدد العملاء والموظفين
-    # العملاء مرتبطون بالشركة
-    customers_count = Customer.query.filter_by(company_id=company_id).count()
-    # الموظفون (نفترض أن role='employee' يميزهم عن المدراء/المستخدمين)
-    employees_count = User.query.filter_by(company_id=company_id, role='employee').count()
+        # (أ + ب) المبيعات والمصروفات للشهرين باستعلام واحد من الملخصات اليومية
+        is_current = DailyRollup.day >= start_current
+        current_sales, previous_sales, current_expenses, previous_expenses = db.session.query(
+            func.coalesce(func.sum(db.case((is_current, DailyRollup.revenue), else_=0)), 0),
+            func.coalesce(func.sum(db.case((is_current, 0), else_=DailyRollup.revenue)), 0),
+            func.coalesce(func.sum(db.case((is_current, DailyRollup.expenses), else_=0)), 0),
+            func.coalesce(func.sum(db.case((is_current, 0), else_=DailyRollup.expenses)), 0)
+        ).filter(
+            DailyRollup.user_id == user_id,
+            DailyRollup.day.between(start_previous, end_current)
+        ).one()
+
+        # (ج) الأرباح (صافي الربح)
+        current_profit = float(current_sales or 0) - float(current_expenses or 0)
+        previous_profit = float(previous_sales or 0) - float(previous_expenses or 0)
+
+        # (د) عدد العملاء والموظفين
+        # العملاء مرتبطون بالمستخدم
+        customers_count = Customer.query.filter_by(user_id=user_id).count()
+        # الموظفون (نفترض أن role='employee' يميزهم عن المدراء/المستخدمين)
+        employees_count = User.query.filter_by(company_id=company_id, role='employee').count()
     
-    # 4. إرجاع البيانات بصيغة JSON
-    return jsonify({
-        "sales": {
-            "current_month": round(float(current_sales), 2),
-            "previous_month": round(float(previous_sales), 2)
-        },
-        "expenses": { # تمت إضافة بيانات المصروفات للاستفادة منها في الرسم البياني
-            "current_month": round(float(current_expenses), 2),
-            "previous_month": round(float(previous_expenses), 2)
-        },
-        "profit": {
-            "current_month": round(current_profit, 2),
-            "previous_month": round(previous_profit, 2)
-        },
-        "counts": {
-            "customers": customers_count,
-            "employees": employees_count
-        },
-        "month_names": { # لإرسال أسماء الأشهر للواجهة الأمامية
-            "current": current_month_name,
-            "previous": previous_month_name
+        # 4. إرجاع البيانات بصيغة JSON
+        return {
+            "sales": {
+                "current_month": round(float(current_sales), 2),
+                "previous_month": round(float(previous_sales), 2)
+            },
+            "expenses": { # تمت إضافة بيانات المصروفات للاستفادة منها في الرسم البياني
+                "current_month": round(float(current_expenses), 2),
+                "previous_month": round(float(previous_expenses), 2)
+            },
+            "profit": {
+                "current_month": round(current_profit, 2),
+                "previous_month": round(previous_profit, 2)
+            },
+            "counts": {
+                "customers": customers_count,
+                "employees": employees_count
+            },
+            "month_names": { # لإرسال أسماء الأشهر للواجهة الأمامية
+                "current": current_month_name,
+                "previous": previous_month_name
+            }
         }
-    }), 200
\ No newline at end of file
+
+    # النتيجة مخزنة مؤقتاً حتى تتغير الملخصات أو العملاء أو الموظفون
+    payload = report_cache.get_or_compute(
+        'comparisons', user_id,
+        [('reports', user_id), ('customers', user_id), ('employees', company_id)],
+        {"today": today},
+        compute
+    )
+    return jsonify(payload), 200
+
+# =========================================================================
+# API: مقارنة عدد من الفترات المتتالية (يوم/أسبوع/شهر/ربع/سنة) باستعلام واحد
+# =========================================================================
+
+COMPARISON_GRANULARITIES = ('day', 'week', 'month', 'quarter', 'year')
+COMPARISON_MAX_PERIODS = 36
+
+
+def period_start(day, granularity):
+    """بداية الفترة التي يقع فيها اليوم."""
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    if granularity == 'quarter':
+        return day.replace(month=3 * ((day.month - 1) // 3) + 1, day=1)
+    if granularity == 'year':
+        return day.replace(month=1, day=1)
+    return day
+
+
+def shift_period(start, granularity, steps):
+    """يحرك بداية الفترة بعدد من الفترات (سالب للخلف)."""
+    if granularity == 'day':
+        return start + timedelta(days=steps)
+    if granularity == 'week':
+        return start + timedelta(weeks=steps)
+    months = {'month': 1, 'quarter': 3, 'year': 12}[granularity] * steps
+    month_index = start.year * 12 + start.month - 1 + months
+    return start.replace(year=month_index // 12, month=month_index % 12 + 1, day=1)
+
+
+def period_label(start, granularity):
+    if granularity == 'week':
+        year, week, _ = start.isocalendar()
+        return f"{year}-W{week:02d}"
+    if granularity == 'month':
+        return start.strftime('%Y-%m')
+    if granularity == 'quarter':
+        return f"{start.year}-Q{(start.month - 1) // 3 + 1}"
+    if granularity == 'year':
+        return str(start.year)
+    return start.isoformat()
+
+
+def same_period_last_year(start, end, granularity):
+    """نفس الفترة قبل عام (52 أسبوعاً لليوم/الأسبوع للحفاظ على يوم الأسبوع)."""
+    if granularity in ('day', 'week'):
+        return start - timedelta(weeks=52), end - timedelta(weeks=52)
+    previous_start = start.replace(year=start.year - 1)
+    previous_end = shift_period(previous_start, granularity, 1) - timedelta(days=1)
+    return previous_start, min(previous_end, previous_start + (end - start))
+
+
+def build_periods(today, granularity, count):
+    """قائمة (البداية، النهاية) لآخر count فترات، الأقدم أولاً، والفترة الحالية حتى اليوم."""
+    current = period_start(today, granularity)
+    periods = []
+    for steps in range(-(count - 1), 1):
+        start = shift_period(current, granularity, steps)
+        end = shift_period(start, granularity, 1) - timedelta(days=1)
+        periods.append((start, min(end, today)))
+    return periods
+
+
+def rollup_totals_by_period(user_id, periods):
+    """يجمع مقاييس الملخصات اليومية لكل الفترات في استعلام GROUP BY واحد."""
+    bucket = db.case(
+        *[(DailyRollup.day.between(start, end), index) for index, (start, end) in enumerate(periods)],
+        else_=None
+    ).label('bucket')
+    rows = db.session.query(
+        bucket,
+        func.sum(DailyRollup.revenue),
+        func.sum(DailyRollup.cogs),
+        func.sum(DailyRollup.expenses),
+        func.sum(DailyRollup.returns_amount),
+        func.sum(DailyRollup.sales_count),
+        func.sum(DailyRollup.items_sold)
+    ).filter(
+        DailyRollup.user_id == user_id,
+        DailyRollup.day.between(min(start for start, _ in periods), max(end for _, end in periods))
+    ).group_by(bucket).all()
+
+    totals = {}
+    for index, revenue, cogs, expenses, returns_amount, sales_count, items_sold in rows:
+        if index is None:
+            continue
+        totals[index] = (revenue, cogs, expenses, returns_amount, sales_count, items_sold)
+    return totals
+
+
+def serialize_period(start, end, granularity, values):
+    revenue, cogs, expenses, returns_amount, sales_count, items_sold = (float(v or 0) for v in values)
+    return {
+        "label": period_label(start, granularity),
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "sales": round(revenue, 2),
+        "cogs": round(cogs, 2),
+        "expenses": round(expenses, 2),
+        "returns": round(returns_amount, 2),
+        "gross_profit": round(revenue - cogs, 2),
+        "net_profit": round(revenue - cogs - expenses, 2),
+        "sales_count": int(sales_count),
+        "items_sold": int(items_sold)
+    }
+
+
+def period_comparison_response(user_id):
+    granularity = request.args.get('granularity', 'month')
+    if granularity not in COMPARISON_GRANULARITIES:
+        return jsonify({"error": "قيمة granularity غير صالحة."}), 400
+    try:
+        count = int(request.args.get('periods', 2))
+    except ValueError:
+        return jsonify({"error": "قيمة periods يجب أن تكون رقماً صحيحاً."}), 400
+    if not 1 <= count <= COMPARISON_MAX_PERIODS:
+        return jsonify({"error": f"عدد الفترات يجب أن يكون بين 1 و {COMPARISON_MAX_PERIODS}."}), 400
+    yoy = request.args.get('yoy') in ('1', 'true')
+
+    today = datetime.now().date()
+    periods = build_periods(today, granularity, count)
+    previous_year = [same_period_last_year(start, end, granularity) for start, end in periods] if yoy else []
+
+    def compute():
+        # كل الفترات (ومقابلاتها قبل عام) في استعلام واحد مهما كان عددها
+        totals = rollup_totals_by_period(user_id, periods + previous_year)
+        empty = (0,) * 6
+        payload = {
+            "granularity": granularity,
+            "periods": [
+                serialize_period(start, end, granularity, totals.get(index, empty))
+                for index, (start, end) in enumerate(periods)
+            ]
+        }
+        if yoy:
+            payload["previous_year"] = [
+                serialize_period(start, end, granularity, totals.get(len(periods) + index, empty))
+                for index, (start, end) in enumerate(previous_year)
+            ]
+        return payload
+
+    payload = report_cache.get_or_compute(
+        'period_comparison', user_id, [('reports', user_id)],
+        {"granularity": granularity, "periods": count, "yoy": yoy, "today": today},
+        compute
+    )
+    return jsonify(payload), 200
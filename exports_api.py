@@ -0,0 +1,260 @@
+import csv
+import io
+import re
+import zipfile
+from datetime import datetime, timedelta
+from decimal import Decimal
+from xml.sax.saxutils import escape
+from flask import Blueprint, Response, jsonify, request, session, stream_with_context
+from sqlalchemy import select
+from app import db, Sale, SaleItem, Return, Customer, Product, stream_transactions, TRANSACTION_STREAM_BATCH
+
+exports_bp = Blueprint('exports_bp', __name__)
+
+# =========================================================================
+# تصدير كامل (CSV / XLSX) بالبث: مؤشرات من جهة الخادم + مولّد استجابة،
+# فالذاكرة ثابتة مهما كان عدد الصفوف والبايتات الأولى تُرسل فوراً
+# =========================================================================
+
+EXPORT_FLUSH_ROWS = 500
+
+
+def export_sales(user_id, start_date, end_date):
+    query = select(
+        Sale.sale_id, Sale.sale_date, Sale.total_amount, Sale.payment_method, Sale.amount_paid, Sale.change_amount
+    ).where(Sale.employee_id == user_id)
+    if start_date:
+        query = query.where(Sale.sale_date >= start_date)
+    if end_date:
+        query = query.where(Sale.sale_date < end_date + timedelta(days=1))
+    return query.order_by(Sale.sale_id)
+
+
+def export_sale_items(user_id, start_date, end_date):
+    query = select(
+        SaleItem.item_id, SaleItem.sale_id, SaleItem.sold_at, SaleItem.product_id, Product.name,
+        SaleItem.quantity, SaleItem.price_per_unit, SaleItem.total_item_price, SaleItem.unit_cost
+    ).outerjoin(Product, SaleItem.product_id == Product.id).where(SaleItem.user_id == user_id)
+    if start_date:
+        query = query.where(SaleItem.sold_at >= start_date)
+    if end_date:
+        query = query.where(SaleItem.sold_at < end_date + timedelta(days=1))
+    return query.order_by(SaleItem.item_id)
+
+
+def export_returns(user_id, start_date, end_date):
+    query = select(
+        Return.return_id, Return.return_date, Return.product_id, Product.name, Return.quantity,
+        Return.cost_price, Return.retail_price, Return.wholesale_price, Return.reason
+    ).outerjoin(Product, Return.product_id == Product.id).where(Return.user_id == user_id)
+    if start_date:
+        query = query.where(Return.return_date >= start_date)
+    if end_date:
+        query = query.where(Return.return_date <= end_date)
+    return query.order_by(Return.return_id)
+
+
+def export_customers(user_id, start_date, end_date):
+    # لا يوجد تاريخ للعملاء، فمرشحات الفترة لا تنطبق
+    return select(
+        Customer.customer_id, Customer.name, Customer.phone, Customer.email, Customer.address,
+        Customer.contact_info, Customer.total_debt, Customer.total_paid,
+        Customer.total_debt - Customer.total_paid
+    ).where(Customer.user_id == user_id).order_by(Customer.customer_id)
+
+
+# المورد -> (عناوين الأعمدة، دالة بناء الاستعلام)
+EXPORTS = {
+    "sales": (
+        ["sale_id", "sale_date", "total_amount", "payment_method", "amount_paid", "change_amount"],
+        export_sales
+    ),
+    "sale_items": (
+        ["item_id", "sale_id", "sold_at", "product_id", "product_name", "quantity",
+         "price_per_unit", "total_item_price", "unit_cost"],
+        export_sale_items
+    ),
+    "returns": (
+        ["return_id", "return_date", "product_id", "product_name", "quantity",
+         "cost_price", "retail_price", "wholesale_price", "reason"],
+        export_returns
+    ),
+    "customers": (
+        ["customer_id", "name", "phone", "email", "address", "contact_info",
+         "total_debt", "total_paid", "remaining_debt"],
+        export_customers
+    ),
+    "transactions": (["type", "id", "date", "details", "amount"], None),
+}
+
+
+def export_rows(resource, user_id, start_date, end_date):
+    """صفوف التصدير كمولّد (بدون تحميل النتيجة كاملة في الذاكرة)."""
+    if resource == "transactions":
+        for t in stream_transactions(user_id, start_date, end_date):
+            yield (t["type"], t["id"], t["date"], t["details"], t["amount"])
+        return
+    _, build_query = EXPORTS[resource]
+    result = db.session.execute(
+        build_query(user_id, start_date, end_date).execution_options(yield_per=TRANSACTION_STREAM_BATCH)
+    )
+    for row in result:
+        yield tuple(row)
+
+
+def format_cell(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ', timespec='seconds')
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def generate_csv(header, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # BOM حتى يفتح Excel النص العربي بترميز UTF-8
+    buffer.write('\ufeff')
+    writer.writerow(header)
+    for count, row in enumerate(rows, 1):
+        writer.writerow([format_cell(v) for v in row])
+        if count % EXPORT_FLUSH_ROWS == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+# -------------------------------------------------------------------------
+# كاتب XLSX بالبث: ملف XLSX أرشيف zip، فنكتب ورقة العمل سطراً بسطر داخل
+# zipfile على مخزن مؤقت غير قابل للتقديم ونفرغه بعد كل دفعة صفوف
+# -------------------------------------------------------------------------
+
+XLSX_STATIC_PARTS = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    "_rels/.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    "xl/workbook.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="export" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    ),
+    "xl/_rels/workbook.xml.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        'Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+# محارف التحكم غير مسموحة في XML
+XML_ILLEGAL_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+class StreamBuffer(io.RawIOBase):
+    """ملف للكتابة فقط يجمع البايتات حتى يفرغها المولّد (zipfile يستخدم واصفات البيانات تلقائياً)."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def xlsx_cell(value):
+    value = format_cell(value)
+    if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+        return f'<c><v>{value}</v></c>'
+    text = XML_ILLEGAL_CHARS.sub('', str(value))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{escape(text)}</t></is></c>'
+
+
+def xlsx_row(values):
+    return '<row>' + ''.join(xlsx_cell(v) for v in values) + '</row>'
+
+
+def generate_xlsx(header, rows):
+    buffer = StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in XLSX_STATIC_PARTS.items():
+            archive.writestr(name, content)
+        yield buffer.drain()
+
+        with archive.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write((
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+                + xlsx_row(header)
+            ).encode('utf-8'))
+            for count, row in enumerate(rows, 1):
+                sheet.write(xlsx_row(row).encode('utf-8'))
+                if count % EXPORT_FLUSH_ROWS == 0:
+                    yield buffer.drain()
+            sheet.write(b'</sheetData></worksheet>')
+    yield buffer.drain()
+
+
+EXPORT_FORMATS = {
+    "csv": (generate_csv, "text/csv; charset=utf-8"),
+    "xlsx": (generate_xlsx, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+}
+
+
+@exports_bp.route('/api/export/<resource>.<any(csv, xlsx):file_format>', methods=['GET'])
+def export_resource(resource, file_format):
+    if 'logged_in' not in session or 'user_id' not in session:
+        return jsonify({"error": "غير مصرح لك بالوصول"}), 401
+    if resource not in EXPORTS:
+        return jsonify({"error": f"مورد غير معروف للتصدير: {resource}"}), 404
+
+    user_id = session['user_id']
+    try:
+        start_date = datetime.strptime(request.args['start_date'], '%Y-%m-%d').date() if request.args.get('start_date') else None
+        end_date = datetime.strptime(request.args['end_date'], '%Y-%m-%d').date() if request.args.get('end_date') else None
+    except ValueError:
+        return jsonify({"error": "تنسيق التاريخ يجب أن يكون YYYY-MM-DD."}), 400
+
+    header, _ = EXPORTS[resource]
+    generate, mimetype = EXPORT_FORMATS[file_format]
+    rows = export_rows(resource, user_id, start_date, end_date)
+    filename = f"{resource}_{datetime.now():%Y%m%d}.{file_format}"
+    return Response(
+        stream_with_context(generate(header, rows)),
+        mimetype=mimetype,
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            # منع التخزين المؤقت في الوكلاء (nginx) حتى تصل البايتات فوراً
+            "X-Accel-Buffering": "no"
+        }
+    )
@@ -0,0 +1,125 @@
+import numpy as np
+
+# =========================================================================
+# نماذج التوقع (NumPy): كل دالة تعمل على مصفوفة (السلاسل × الأيام) دفعة واحدة،
+# فكل المستخدمين يُحسبون معاً دون حلقات Python لكل مستخدم
+# =========================================================================
+
+SEASON_LENGTH = 7            # موسمية أسبوعية للسلاسل اليومية
+MOVING_AVERAGE_WINDOW = 28
+CONFIDENCE_Z = 1.96          # فترة ثقة 95%
+TREND_DAMPING = 0.98         # اتجاه مخمّد حتى لا ينفجر التوقع على آفاق طويلة
+
+# شبكة معاملات Holt-Winters (alpha, beta, gamma) تُجرب كلها بالتوازي لكل سلسلة
+HOLT_WINTERS_GRID = np.array(
+    [(a, b, g) for a in (0.1, 0.3, 0.5) for b in (0.01, 0.1) for g in (0.05, 0.2, 0.4)]
+)
+
+
+def build_series_matrix(row_index, day_index, values, rows, days):
+    """يحول صفوف (السلسلة، اليوم، القيمة) المتفرقة إلى مصفوفة كثيفة، والأيام الفارغة أصفار."""
+    matrix = np.zeros((rows, days))
+    np.add.at(matrix, (row_index, day_index), values)
+    return matrix
+
+
+def moving_average_model(series, window=MOVING_AVERAGE_WINDOW):
+    """متوسط متحرك: التوقع ثابت = متوسط آخر window يوم.
+
+    يعيد (المستوى، أخطاء التوقع بخطوة واحدة داخل العينة) لكل سلسلة.
+    """
+    n_series, length = series.shape
+    window = min(window, length)
+    cumulative = np.concatenate([np.zeros((n_series, 1)), np.cumsum(series, axis=1)], axis=1)
+    # توقع اليوم t هو متوسط الأيام [t-window, t)
+    one_step = (cumulative[:, window:-1] - cumulative[:, :length - window]) / window
+    errors = series[:, window:] - one_step
+    level = (cumulative[:, -1] - cumulative[:, -1 - window]) / window
+    return level, errors
+
+
+def holt_winters_model(series, season_length=SEASON_LENGTH, grid=HOLT_WINTERS_GRID, phi=TREND_DAMPING):
+    """Holt-Winters جمعي (مستوى + اتجاه مخمّد + موسمية) مع اختيار أفضل معاملات من الشبكة لكل سلسلة.
+
+    الحلقة على الزمن فقط؛ كل خطوة تحدّث (السلاسل × تركيبات المعاملات) معاً.
+    يتطلب موسمين كاملين على الأقل من البيانات.
+    """
+    n_series, length = series.shape
+    m = season_length
+    alpha, beta, gamma = (grid[:, i][None, :] for i in range(3))
+    n_combos = grid.shape[0]
+
+    first, second = series[:, :m].mean(axis=1), series[:, m:2 * m].mean(axis=1)
+    level = np.repeat(first[:, None], n_combos, axis=1)
+    trend = np.repeat(((second - first) / m)[:, None], n_combos, axis=1)
+    season = np.repeat((series[:, :m] - first[:, None])[:, None, :], n_combos, axis=1)
+
+    errors = np.empty((n_series, n_combos, length - m))
+    for t in range(m, length):
+        s = t % m
+        y = series[:, t][:, None]
+        errors[:, :, t - m] = y - (level + phi * trend + season[:, :, s])
+        new_level = alpha * (y - season[:, :, s]) + (1 - alpha) * (level + phi * trend)
+        trend = beta * (new_level - level) + (1 - beta) * phi * trend
+        season[:, :, s] = gamma * (y - new_level) + (1 - gamma) * season[:, :, s]
+        level = new_level
+
+    best = np.argmin(np.square(errors).sum(axis=2), axis=1)
+    rows = np.arange(n_series)
+    return {
+        "level": level[rows, best],
+        "trend": trend[rows, best],
+        "season": season[rows, best],
+        "params": grid[best],
+        "errors": errors[rows, best],
+    }
+
+
+def forecast_series(series, horizon, season_length=SEASON_LENGTH):
+    """يختار لكل سلسلة النموذج الأقل خطأً داخل العينة ويعيد التوقع اليومي وحدود الثقة.
+
+    النتيجة: قاموس فيه forecast و lower و upper بالشكل (السلاسل × horizon)،
+    و model (اسم النموذج لكل سلسلة) و params (alpha, beta, gamma أو NaN للمتوسط المتحرك).
+    """
+    n_series, length = series.shape
+    steps = np.arange(1, horizon + 1)
+
+    ma_level, ma_errors = moving_average_model(series)
+    ma_forecast = np.repeat(ma_level[:, None], horizon, axis=1)
+    ma_sigma = np.sqrt(np.mean(np.square(ma_errors), axis=1)) if ma_errors.shape[1] else np.zeros(n_series)
+    # تباين المتوسط المتحرك لا يتزايد مع الأفق
+    ma_spread = ma_sigma[:, None] * np.ones((1, horizon))
+
+    forecast, spread = ma_forecast, ma_spread
+    model = np.full(n_series, 'moving_average', dtype=object)
+    params = np.full((n_series, 3), np.nan)
+
+    if length >= 2 * season_length + MOVING_AVERAGE_WINDOW:
+        hw = holt_winters_model(series, season_length)
+        season_index = (length + steps - 1) % season_length
+        damped_steps = np.cumsum(TREND_DAMPING ** steps)
+        hw_forecast = hw["level"][:, None] + damped_steps[None, :] * hw["trend"][:, None] + hw["season"][:, season_index]
+        hw_sigma = np.sqrt(np.mean(np.square(hw["errors"]), axis=1))
+        # تقريب تباين الأفق h بصيغة التمهيد الأسي: sigma² (1 + (h-1) alpha²)
+        alpha = hw["params"][:, 0][:, None]
+        hw_spread = hw_sigma[:, None] * np.sqrt(1 + (steps[None, :] - 1) * np.square(alpha))
+
+        # المقارنة على نفس الأيام الأخيرة لكلا النموذجين
+        overlap = ma_errors.shape[1]
+        use_hw = (
+            np.mean(np.square(hw["errors"][:, -overlap:]), axis=1)
+            < np.mean(np.square(ma_errors), axis=1)
+        )
+        forecast = np.where(use_hw[:, None], hw_forecast, ma_forecast)
+        spread = np.where(use_hw[:, None], hw_spread, ma_spread)
+        model = np.where(use_hw, 'holt_winters', model)
+        params = np.where(use_hw[:, None], hw["params"], params)
+
+    return {
+        "forecast": forecast,
+        "lower": forecast - CONFIDENCE_Z * spread,
+        "upper": forecast + CONFIDENCE_Z * spread,
+        "spread": spread,
+        "model": model,
+        "params": params,
+    }
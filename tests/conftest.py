@@ -0,0 +1,43 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# قاعدة بيانات SQLite مؤقتة؛ يجب ضبطها قبل استيراد التطبيق (الاتصال يُهيأ عند الاستيراد)
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import app as flask_app, db, User  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def app():
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        db.create_all()
+        yield flask_app
+
+
+@pytest.fixture
+def make_user(app):
+    """ينشئ مستخدماً جديداً لكل اختبار حتى لا تتشارك الاختبارات البيانات."""
+    def make(**fields):
+        user = User(name=fields.pop('name', 'مستخدم اختبار'), role=fields.pop('role', 'company_admin'), **fields)
+        db.session.add(user)
+        db.session.commit()
+        return user
+    return make
+
+
+@pytest.fixture
+def login(app):
+    """يعيد عميل اختبار بجلسة مسجلة لمستخدم معين."""
+    def make(user):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['logged_in'] = True
+            session['user_id'] = user.id
+            session['role'] = user.role
+        return client
+    return make
@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta
+
+from app import db, Customer, CustomerLedgerEntry
+
+
+def add_customer(user_id, name, entries, total_debt=None, total_paid=0):
+    """عميل بقيود دفتر [(النوع، المبلغ، منذ كم يوم)]؛ الأرصدة تطابق القيود ما لم تُحدد."""
+    debt = sum(amount for kind, amount, _ in entries if kind == 'debt')
+    paid = sum(amount for kind, amount, _ in entries if kind == 'payment')
+    customer = Customer(
+        user_id=user_id, name=name,
+        total_debt=debt if total_debt is None else total_debt,
+        total_paid=paid or total_paid
+    )
+    db.session.add(customer)
+    db.session.flush()
+    now = datetime.utcnow()
+    db.session.add_all([
+        CustomerLedgerEntry(customer_id=customer.customer_id, user_id=user_id, entry_type=kind,
+                            amount=amount, created_at=now - timedelta(days=days_ago))
+        for kind, amount, days_ago in entries
+    ])
+    db.session.commit()
+
+
+def test_aging_allocates_payments_to_oldest_debt_first(make_user, login):
+    user = make_user()
+    user_id, client = user.id, login(user)
+    # تسديد جزئي لدين قديم ثم دين جديد: المتبقي 110 = الدين الجديد 50 + 60 من القديم
+    add_customer(user_id, "أحمد", [('debt', 100, 100), ('payment', 40, 20), ('debt', 50, 5)])
+    # التسديد يغطي الدين الأقدم (30) كاملاً ثم 20 من دين الـ 45 يوماً
+    add_customer(user_id, "سارة", [('debt', 30, 70), ('debt', 80, 45), ('payment', 50, 10)])
+    # رصيد قديم بلا قيود في الدفتر
+    add_customer(user_id, "خالد", [], total_debt=25)
+
+    body = client.get('/api/customers/aging').get_json()
+
+    assert {b["label"]: (b["amount"], b["customers"]) for b in body["buckets"]} == {
+        "0-30": (50, 1), "31-60": (60, 1), "61-90": (0, 0), "90+": (60, 1)
+    }
+    assert body["total_outstanding"] == 195
+    assert body["debtors"] == 3
+    assert body["unaged"] == 25
+    assert [d["name"] for d in body["top_debtors"]] == ["أحمد", "سارة", "خالد"]
+
+
+def test_aging_top_is_clamped(make_user, login):
+    user = make_user()
+    user_id, client = user.id, login(user)
+    add_customer(user_id, "أحمد", [('debt', 100, 5)])
+    add_customer(user_id, "سارة", [('debt', 80, 5)])
+
+    assert [d["name"] for d in client.get('/api/customers/aging?top=-5').get_json()["top_debtors"]] == ["أحمد"]
+    assert client.get('/api/customers/aging?top=abc').status_code == 400
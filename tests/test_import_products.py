@@ -0,0 +1,23 @@
+from app import Product, import_products_command
+
+
+def write_csv(tmp_path):
+    path = tmp_path / "products.csv"
+    path.write_text("name,quantity_in_stock,cost_price\nمنتج مستورد,3,2.5\n", encoding="utf-8")
+    return str(path)
+
+
+def test_import_products_for_unknown_user_fails(app, tmp_path):
+    result = app.test_cli_runner().invoke(import_products_command, [write_csv(tmp_path), "--user-id", "999999"])
+
+    assert result.exit_code != 0
+    assert "المستخدم 999999 غير موجود." in result.output
+
+
+def test_import_products_inserts_rows(app, make_user, tmp_path):
+    user_id = make_user().id
+
+    result = app.test_cli_runner().invoke(import_products_command, [write_csv(tmp_path), "--user-id", str(user_id)])
+
+    assert result.exit_code == 0
+    assert [p.name for p in Product.query.filter_by(user_id=user_id)] == ["منتج مستورد"]
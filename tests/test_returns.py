@@ -0,0 +1,75 @@
+from datetime import date, timedelta
+
+import pytest
+from sqlalchemy import event, insert
+
+from app import db, Product, Return
+
+
+def add_returns(user, count):
+    """يضيف count مرتجعاً على count / 3 منتج (عدد المنتجات يكبر مع المرتجعات)، وبعضها لمنتج محذوف."""
+    products = [
+        Product(user_id=user.id, name=f"منتج {i}", quantity_in_stock=10, cost_price=5)
+        for i in range(count // 3)
+    ]
+    db.session.add_all(products)
+    db.session.flush()
+    product_ids = [p.id for p in products] + [None]
+    db.session.execute(insert(Return), [
+        {
+            "user_id": user.id,
+            "product_id": product_ids[i % len(product_ids)],
+            "quantity": 1,
+            "return_date": date(2026, 1, 1) + timedelta(days=i % 90),
+            "retail_price": 10
+        }
+        for i in range(count)
+    ])
+    db.session.commit()
+
+
+def count_statements(client, url):
+    """عدد عبارات SQL التي ينفذها طلب واحد."""
+    # جلسة جديدة كطلب حقيقي: الكائنات المحملة مسبقاً تخفي الاستعلامات الكسولة
+    db.session.remove()
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        response = client.get(url)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+    assert response.status_code == 200
+    return len(statements), response.get_json()
+
+
+@pytest.mark.parametrize('url', ['/api/returns', '/api/returns?limit=500'])
+def test_returns_listing_issues_constant_statements(make_user, login, url):
+    small_user, large_user = make_user(), make_user()
+    add_returns(small_user, 30)
+    add_returns(large_user, 300)
+    small_client, large_client = login(small_user), login(large_user)
+
+    small_count, _ = count_statements(small_client, url)
+    large_count, large_body = count_statements(large_client, url)
+
+    # أسماء المنتجات تأتي مع المرتجعات في نفس الاستعلام، لا استعلام لكل مرتجع
+    assert small_count == large_count
+    items = large_body if isinstance(large_body, list) else large_body["items"]
+    assert len(items) == 300
+    assert {item["name"] for item in items} == {f"منتج {i}" for i in range(100)} | {"منتج محذوف"}
+
+
+def test_returns_listing_is_scoped_to_user(make_user, login):
+    owner, other = make_user(), make_user()
+    add_returns(owner, 3)
+    add_returns(other, 4)
+    owner_id, client = owner.id, login(owner)
+
+    _, body = count_statements(client, '/api/returns')
+
+    assert len(body) == 3
+    assert {item["user_id"] for item in body} == {owner_id}
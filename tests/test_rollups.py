@@ -0,0 +1,67 @@
+from datetime import date
+from decimal import Decimal
+
+from app import db, DailyRollup, Expense, ROLLUP_METRICS, compute_rollups_from_facts
+
+
+def stored_rollups(user_id):
+    """الملخصات المخزنة بصيغة compute_rollups_from_facts، مع إسقاط الأيام الصفرية."""
+    rows = DailyRollup.query.filter_by(user_id=user_id).all()
+    return {
+        (row.user_id, row.day): {metric: Decimal(str(getattr(row, metric) or 0)) for metric in ROLLUP_METRICS}
+        for row in rows
+        if any(getattr(row, metric) for metric in ROLLUP_METRICS)
+    }
+
+
+def expected_rollups(user_id):
+    return {
+        key: {metric: Decimal(str(values[metric] or 0)) for metric in ROLLUP_METRICS}
+        for key, values in compute_rollups_from_facts(user_id).items()
+    }
+
+
+def edit_expense(expense_id, **fields):
+    # كائن منتهي الصلاحية بعد commit كما في طلب حقيقي
+    db.session.remove()
+    expense = db.session.get(Expense, expense_id)
+    db.session.commit()
+    for name, value in fields.items():
+        setattr(expense, name, value)
+    db.session.commit()
+
+
+def test_editing_committed_expense_updates_rollups(make_user):
+    user_id, other_id = make_user().id, make_user().id
+    expense = Expense(user_id=user_id, description="إيجار", amount=50, expense_date=date(2026, 3, 1))
+    db.session.add(expense)
+    db.session.commit()
+    expense_id = expense.expense_id
+
+    edit_expense(expense_id, amount=70)
+    assert stored_rollups(user_id) == expected_rollups(user_id)
+    assert stored_rollups(user_id)[(user_id, date(2026, 3, 1))]["expenses"] == 70
+
+    edit_expense(expense_id, amount=90, expense_date=date(2026, 3, 5))
+    assert stored_rollups(user_id) == expected_rollups(user_id)
+    assert (user_id, date(2026, 3, 1)) not in stored_rollups(user_id)
+
+    edit_expense(expense_id, user_id=other_id)
+    assert stored_rollups(user_id) == expected_rollups(user_id) == {}
+    assert stored_rollups(other_id) == expected_rollups(other_id)
+
+
+def test_deleting_committed_expense_updates_rollups(make_user):
+    user_id = make_user().id
+    db.session.add_all([
+        Expense(user_id=user_id, description="كهرباء", amount=30, expense_date=date(2026, 4, 1)),
+        Expense(user_id=user_id, description="مياه", amount=12, expense_date=date(2026, 4, 1)),
+    ])
+    db.session.commit()
+
+    db.session.remove()
+    db.session.delete(Expense.query.filter_by(user_id=user_id, description="كهرباء").one())
+    db.session.commit()
+
+    assert stored_rollups(user_id) == expected_rollups(user_id)
+    assert stored_rollups(user_id)[(user_id, date(2026, 4, 1))]["expenses"] == 12
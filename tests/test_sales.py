@@ -0,0 +1,45 @@
+import pytest
+
+from app import db, Product, Sale
+
+
+def add_product(user, retail_price):
+    product = Product(user_id=user.id, name="منتج", quantity_in_stock=5, cost_price=4, retail_price=retail_price)
+    db.session.add(product)
+    db.session.commit()
+    return product.id
+
+
+def sell(client, product_id, retail_price):
+    return client.post('/api/sales', json={
+        "payment_method": "cash",
+        "cart": [{"id": product_id, "quantity": 1, "retail_price": retail_price}]
+    })
+
+
+@pytest.mark.parametrize('client_price', [-100, "NaN", 10])
+def test_sale_of_unpriced_product_is_rejected(make_user, login, client_price):
+    user = make_user()
+    user_id, client = user.id, login(user)
+    product_id = add_product(user, retail_price=None)
+
+    response = sell(client, product_id, client_price)
+
+    assert response.status_code == 400
+    assert "سعر" in response.get_json()["error"]
+    assert Sale.query.filter_by(employee_id=user_id).count() == 0
+    assert db.session.get(Product, product_id).quantity_in_stock == 5
+
+
+@pytest.mark.parametrize('client_price', [-100, "NaN", 1])
+def test_sale_total_ignores_client_price(make_user, login, client_price):
+    user = make_user()
+    user_id, client = user.id, login(user)
+    product_id = add_product(user, retail_price=12)
+
+    response = sell(client, product_id, client_price)
+
+    assert response.status_code == 201
+    sale = Sale.query.filter_by(employee_id=user_id).one()
+    assert float(sale.total_amount) == 12
+    assert db.session.get(Product, product_id).quantity_in_stock == 4